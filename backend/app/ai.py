@@ -3,149 +3,585 @@ import uuid
 import time
 import json
 import re
-from typing import Dict, Any, List, Optional
-from datetime import datetime, timedelta
+import asyncio
+import heapq
+import hashlib
+from collections import deque
+from types import SimpleNamespace
+from functools import lru_cache
+from typing import Dict, Any, Deque, List, NamedTuple, Optional, Sequence, Set
+from datetime import datetime, timedelta, timezone
+from cachetools import TTLCache
+import fastjsonschema
 
-# OpenAI client: only initialize if API key present
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# OpenAI client: only used if API key present
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 USE_OPENAI = bool(OPENAI_API_KEY)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_MAX_ATTEMPTS = 3
+OPENAI_MAX_BACKOFF = 8.0
+# The second call only turns tool results into prose, so a smaller model is enough
+_SUMMARIZE_MODEL = os.getenv("OPENAI_SUMMARIZE_MODEL", "gpt-4o-mini")
+# Upper bound on tool calls executed at once, to respect downstream rate limits
+TOOL_CONCURRENCY = 10
 
 openai_client = None
-if USE_OPENAI:
+
+
+def _make_http_client():
+    """
+    Pooled HTTP client for the OpenAI SDK. Keeps enough warm connections for bursts and
+    multiplexes requests over HTTP/2 when the h2 package is installed.
+    """
+    import httpx
     try:
-        from openai import OpenAI
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
-    except Exception as e:
-        print("OpenAI client init failed:", e)
-        openai_client = None
-        USE_OPENAI = False
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+        http2=http2,
+    )
+
+
+def _get_openai_client():
+    """
+    Create the OpenAI client on first use. The SDK import is heavy, so it is
+    deferred to keep worker start-up fast and the mock path free of it.
+    """
+    global openai_client, USE_OPENAI
+    if openai_client is None and USE_OPENAI:
+        try:
+            from openai import AsyncOpenAI
+            # Retries are handled by _chat_completion
+            openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=_make_http_client())
+        except Exception as e:
+            print("OpenAI client init failed:", e)
+            openai_client = None
+            USE_OPENAI = False
+    return openai_client
 
 # MCP tools
 from app.mcp import tools as mcp_tools
+from app.db import get_redis
+
+
+# JSON helpers: orjson when available, stdlib json otherwise
+def _json_dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def _json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+_tool_semaphore = asyncio.Semaphore(TOOL_CONCURRENCY)
+
+
+def _retry_after_seconds(exc) -> Optional[float]:
+    # Honor the server's Retry-After hint on 429/5xx responses
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(value), OPENAI_MAX_BACKOFF) if value else None
+    except ValueError:
+        return None
+
+
+async def _chat_completion(**kwargs):
+    """
+    Await chat.completions.create with a timeout, retrying transient failures
+    (rate limits, timeouts, connection and 5xx errors) with exponential backoff.
+    """
+    client = _get_openai_client()
+    import openai
+
+    transient = (
+        asyncio.TimeoutError,
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+    delay = 1.0
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        try:
+            return await asyncio.wait_for(client.chat.completions.create(**kwargs), timeout=OPENAI_TIMEOUT)
+        except transient as e:
+            if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                raise
+            wait = _retry_after_seconds(e) or delay
+            print(f"OpenAI call failed ({type(e).__name__}), retry {attempt + 1} in {wait:.1f}s")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, OPENAI_MAX_BACKOFF)
+
+
+class _CompletionBatcher:
+    """
+    Coalesces identical completion requests that arrive within a short window
+    into a single call with n=len(batch); each caller receives its own choice.
+    Requests whose prompts differ are still sent as separate calls.
+    """
+
+    def __init__(self, window_s: float, max_size: int):
+        self.window_s = window_s
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to tasks; hold dispatches until they finish
+        self._dispatches: Set[asyncio.Task] = set()
+
+    async def submit(self, **kwargs):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((kwargs, fut))
+        return await fut
+
+    @staticmethod
+    def _fail(pending, exc: Exception):
+        for _, fut in pending:
+            if not fut.done():
+                fut.set_exception(exc)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self.window_s)
+            except asyncio.CancelledError:
+                self._fail(batch, RuntimeError("OpenAI client closed"))
+                raise
+            while len(batch) < self.max_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
 
-# Sessions (in-memory)
-sessions: Dict[str, List[Dict[str, Any]]] = {}
+            groups: Dict[str, List[Any]] = {}
+            for kwargs, fut in batch:
+                groups.setdefault(_json_dumps(kwargs), []).append((kwargs, fut))
+            for group in groups.values():
+                task = asyncio.create_task(self._dispatch(group))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, group):
+        kwargs = group[0][0]
+        try:
+            if len(group) > 1:
+                resp = await _chat_completion(**kwargs, n=len(group))
+            else:
+                resp = await _chat_completion(**kwargs)
+        except asyncio.CancelledError:
+            self._fail(group, RuntimeError("OpenAI client closed"))
+            raise
+        except Exception as e:
+            self._fail(group, e)
+            return
+        for choice, (_, fut) in zip(resp.choices, group):
+            if not fut.done():
+                fut.set_result(choice)
+
+    async def aclose(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._dispatches):
+            task.cancel()
+        await asyncio.gather(*self._dispatches, return_exceptions=True)
+        # Requests still queued never reached the worker; fail them so their callers don't hang
+        while self._queue is not None and not self._queue.empty():
+            self._fail([self._queue.get_nowait()], RuntimeError("OpenAI client closed"))
+
+
+# Micro-batching of tool-selection requests; disabled unless a window is configured
+OPENAI_BATCH_WINDOW_MS = int(os.getenv("OPENAI_BATCH_WINDOW_MS", "0"))
+OPENAI_BATCH_MAX = 16
+_batcher = _CompletionBatcher(OPENAI_BATCH_WINDOW_MS / 1000, OPENAI_BATCH_MAX) if OPENAI_BATCH_WINDOW_MS > 0 else None
+
+
+async def _first_choice(**kwargs):
+    # Only the stateless tool-selection call is batched; follow-ups after tool_calls never are
+    if _batcher is not None:
+        return await _batcher.submit(**kwargs)
+    resp = await _chat_completion(**kwargs)
+    return resp.choices[0]
+
+
+async def aclose():
+    # Release the pooled HTTP connections held by the OpenAI client (closes its httpx client too)
+    if _batcher is not None:
+        await _batcher.aclose()
+    if openai_client is not None:
+        await openai_client.close()
+
+# Sessions live in Redis when REDIS_URL is set, so every worker sees the same history.
+# Otherwise they are kept in-process in a TTLCache: sessions expire SESSION_TTL after
+# their last message and the oldest are evicted once MAX_SESSIONS is reached. Each history
+# is bounded to SESSION_MAX_LEN entries.
 SESSION_MAX_LEN = 20
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+
+
+class Msg(NamedTuple):
+    role: str
+    content: str
+    time: int
+
+
+sessions: "TTLCache[str, Deque[Msg]]" = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
 
 
 def _now_ts():
     return int(time.time())
 
 
+class _MemorySessionStore:
+    """In-process session store backed by the module-level `sessions` cache."""
+
+    def create(self, session_id: str):
+        sessions[session_id] = deque(maxlen=SESSION_MAX_LEN)
+
+    async def append(self, session_id: str, msg: Msg):
+        history = sessions.get(session_id)
+        if history is None:
+            history = deque(maxlen=SESSION_MAX_LEN)
+        history.append(msg)
+        # TTLCache only sets an expiry on assignment; re-assigning keeps active sessions alive
+        sessions[session_id] = history
+
+    async def history(self, session_id: str) -> Sequence[Msg]:
+        return sessions.get(session_id, ())
+
+
+class _RedisSessionStore:
+    """Session store shared by all workers; each history is a capped Redis list."""
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"sess:{session_id}"
+
+    def create(self, session_id: str):
+        # The list is created lazily by the first RPUSH
+        pass
+
+    async def append(self, session_id: str, msg: Msg):
+        key = self._key(session_id)
+        # LTRIM keeps the bounded-length semantics server-side
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, _json_dumps(list(msg)))
+            pipe.ltrim(key, -SESSION_MAX_LEN, -1)
+            pipe.expire(key, SESSION_TTL)
+            await pipe.execute()
+
+    async def history(self, session_id: str) -> Sequence[Msg]:
+        return [Msg(*_json_loads(raw)) for raw in await self.client.lrange(self._key(session_id), 0, -1)]
+
+
+_memory_store = _MemorySessionStore()
+
+
+def _session_store():
+    r = get_redis()
+    return _RedisSessionStore(r) if r is not None else _memory_store
+
+
 def create_session() -> str:
     sid = str(uuid.uuid4())
-    sessions[sid] = []
+    _session_store().create(sid)
     return sid
 
 
-def append_session(session_id: str, role: str, content: str):
-    if session_id not in sessions:
-        sessions[session_id] = []
-    sessions[session_id].append({"role": role, "content": content, "time": _now_ts()})
-    if len(sessions[session_id]) > SESSION_MAX_LEN:
-        sessions[session_id] = sessions[session_id][-SESSION_MAX_LEN:]
-
-
-def get_session_history(session_id: str) -> List[Dict[str, Any]]:
-    return sessions.get(session_id, [])
-
-
-def build_tools_schema():
-    return [
-        {
-            "type": "function",
-            "function": {
-                "name": "get_doctor_availability",
-                "description": "Return available slots for a doctor.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "doctor_name": {"type": "string"},
-                        "start_date": {"type": "string"},
-                        "end_date": {"type": "string"},
-                        "time_of_day": {"type": "string"},
-                    },
-                    "required": ["doctor_name", "start_date"],
+async def append_session(session_id: str, role: str, content: str):
+    await _session_store().append(session_id, Msg(role, content, _now_ts()))
+
+
+async def get_session_history(session_id: str) -> Sequence[Msg]:
+    return await _session_store().history(session_id)
+
+
+# Token budget for the history sent to OpenAI; the oldest turns are dropped first
+HISTORY_TOKEN_BUDGET = int(os.getenv("OPENAI_HISTORY_TOKENS", "2000"))
+# Seconds to wait before retrying a failed tiktoken load
+ENCODING_RETRY_SECONDS = 300
+_encoding = None
+_encoding_failed_at = None
+_encoding_loading = None
+
+
+def _load_encoding():
+    """
+    Load the tiktoken encoding for the gpt-4o/4.1 family. The first load may download its
+    vocabulary, so this runs in a worker thread; failures are retried after a backoff.
+    """
+    global _encoding, _encoding_failed_at
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print("tiktoken unavailable, estimating token counts:", e)
+        _encoding_failed_at = time.monotonic()
+        return
+    _encoding_failed_at = None
+    # Drop the chars/4 estimates counted while the encoding was missing
+    _count_tokens.cache_clear()
+
+
+def preload_encoding():
+    """Start loading the encoding in the background; call from the running event loop."""
+    _get_encoding()
+
+
+def _get_encoding():
+    """
+    The loaded encoding, or None while it is unavailable (counts then fall back to a chars/4
+    estimate). A missing encoding is loaded in the background, never on the event loop.
+    """
+    global _encoding_loading
+    if _encoding is not None:
+        return _encoding
+    if _encoding_loading is not None and not _encoding_loading.done():
+        return None
+    if _encoding_failed_at is not None and time.monotonic() - _encoding_failed_at < ENCODING_RETRY_SECONDS:
+        return None
+    try:
+        _encoding_loading = asyncio.get_running_loop().run_in_executor(None, _load_encoding)
+    except RuntimeError:
+        # No event loop (scripts): nothing to block but the caller
+        _load_encoding()
+    return _encoding
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+    # History entries are resent on every turn, so each one is only encoded once
+    enc = _get_encoding()
+    return len(enc.encode(text)) if enc is not None else len(text) // 4 + 1
+
+
+def _trim_history(history: Sequence[Msg]) -> List[Msg]:
+    """Keep the newest turns that fit in HISTORY_TOKEN_BUDGET; the latest one is always kept."""
+    total = 0
+    keep = 0
+    for m in reversed(history):
+        total += _count_tokens(m.content)
+        if total > HISTORY_TOKEN_BUDGET and keep:
+            break
+        keep += 1
+    return list(history)[len(history) - keep:]
+
+
+# Tool definitions advertised to the model (invariant, built once at import)
+TOOLS_SCHEMA = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_doctor_availability",
+            "description": "Return available slots for a doctor.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "doctor_name": {"type": "string"},
+                    "start_date": {"type": "string"},
+                    "end_date": {"type": "string"},
+                    "time_of_day": {"type": "string"},
                 },
+                "required": ["doctor_name", "start_date"],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "create_appointment",
-                "description": "Book an appointment.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "doctor_name": {"type": "string"},
-                        "patient_name": {"type": "string"},
-                        "patient_email": {"type": "string"},
-                        "start_iso": {"type": "string"},
-                        "end_iso": {"type": "string"},
-                        "reason": {"type": "string"},
-                    },
-                    "required": [
-                        "doctor_name",
-                        "patient_name",
-                        "patient_email",
-                        "start_iso",
-                        "end_iso",
-                    ],
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_doctor_availability_many",
+            "description": "Return available slots for several doctors at once, e.g. to compare them.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "doctor_names": {"type": "array", "items": {"type": "string"}, "minItems": 1},
+                    "start_date": {"type": "string"},
+                    "end_date": {"type": "string"},
+                    "time_of_day": {"type": "string"},
                 },
+                "required": ["doctor_names", "start_date"],
             },
         },
-        {
-    "type": "function",
-    "function": {
-    "name": "get_doctor_summary_report",
-    "description": "Return a summary report of patient counts and reasons, and optionally notify the doctor through Slack.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-        "doctor_name": { "type": "string", "description": "Doctor full name, e.g. 'Dr. Ahuja'." },
-        "ref_date": { "type": "string", "description": "Reference date in YYYY-MM-DD format (optional). If omitted, defaults to today." },
-        "send_notification": { "type": "boolean", "description": "If true, send the summary to the doctor's Slack webhook (if configured)." }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "create_appointment",
+            "description": "Book an appointment.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "doctor_name": {"type": "string"},
+                    "patient_name": {"type": "string"},
+                    "patient_email": {"type": "string"},
+                    "start_iso": {"type": "string"},
+                    "end_iso": {"type": "string"},
+                    "reason": {"type": "string"},
+                },
+                "required": [
+                    "doctor_name",
+                    "patient_name",
+                    "patient_email",
+                    "start_iso",
+                    "end_iso",
+                ],
+            },
         },
-        "required": ["doctor_name"]
-    }
-    }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_doctor_summary_report",
+            "description": "Return a summary report of patient counts and reasons, and optionally notify the doctor through Slack.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "doctor_name": {"type": "string", "description": "Doctor full name, e.g. 'Dr. Ahuja'."},
+                    "ref_date": {"type": "string", "description": "Reference date in YYYY-MM-DD format (optional). If omitted, defaults to today."},
+                    "send_notification": {"type": "boolean", "description": "If true, send the summary to the doctor's Slack webhook (if configured)."},
+                },
+                "required": ["doctor_name"],
+            },
+        },
+    },
+]
+
+
+# Doctor-only tools are hidden from everyone else
+_PATIENT_TOOLS_SCHEMA = [t for t in TOOLS_SCHEMA if t["function"]["name"] != "get_doctor_summary_report"]
+
+# Argument validators generated once from the schema above
+_VALIDATORS = {
+    spec["function"]["name"]: fastjsonschema.compile(spec["function"]["parameters"])
+    for spec in TOOLS_SCHEMA
+}
+
+
+# Tool name -> (adapter mapping the schema's argument names onto the MCP tool's parameters,
+#               role required to call it, or None when open to everyone)
+_TOOL_DISPATCH = {
+    "get_doctor_availability": (lambda a: mcp_tools.get_doctor_availability(
+        doctor_name=a.get("doctor_name"),
+        start_date_str=a.get("start_date"),
+        end_date_str=a.get("end_date"),
+        time_of_day=a.get("time_of_day"),
+    ), None),
+    "get_doctor_availability_many": (lambda a: mcp_tools.get_doctor_availability_many(
+        doctor_names=a.get("doctor_names"),
+        start_date_str=a.get("start_date"),
+        end_date_str=a.get("end_date"),
+        time_of_day=a.get("time_of_day"),
+    ), None),
+    "create_appointment": (lambda a: mcp_tools.create_appointment(
+        doctor_name=a.get("doctor_name"),
+        patient_name=a.get("patient_name"),
+        patient_email=a.get("patient_email"),
+        start_iso=a.get("start_iso"),
+        end_iso=a.get("end_iso"),
+        reason=a.get("reason"),
+    ), None),
+    "get_doctor_summary_report": (lambda a: mcp_tools.get_doctor_summary_report(
+        doctor_name=a.get("doctor_name"),
+        ref_date_str=a.get("ref_date"),
+        send_notification=a.get("send_notification", True),
+    ), "doctor"),
 }
-    ]
 
 
 # Call the MCP tool functions, with optional role-based access control
 def call_tool_by_name(name: str, args: dict, token_info: Optional[dict] = None):
     role = (token_info or {}).get("role")
-    try:
-        if name == "get_doctor_availability":
-            return mcp_tools.get_doctor_availability(
-                doctor_name=args.get("doctor_name"),
-                start_date_str=args.get("start_date"),
-                end_date_str=args.get("end_date"),
-                time_of_day=args.get("time_of_day"),
-            )
-        if name == "create_appointment":
-            return mcp_tools.create_appointment(
-                doctor_name=args.get("doctor_name"),
-                patient_name=args.get("patient_name"),
-                patient_email=args.get("patient_email"),
-                start_iso=args.get("start_iso"),
-                end_iso=args.get("end_iso"),
-                reason=args.get("reason"),
-            )
-        if name == "get_doctor_summary_report":
-            if role != "doctor":
-                return {"ok": False, "error": "forbidden: get_doctor_summary_report is restricted to doctors"}
-            return mcp_tools.get_doctor_summary_report(
-                doctor_name=args.get("doctor_name"),
-                ref_date_str=args.get("ref_date"),
-                send_notification=args.get("send_notification", True)
-            )
+    fn, required_role = _TOOL_DISPATCH.get(name, (None, None))
+    if fn is None:
         return {"ok": False, "error": f"Unknown tool '{name}'"}
+    if required_role and role != required_role:
+        return {"ok": False, "error": f"forbidden: {name} is restricted to {required_role}s"}
+    if isinstance(args, dict):
+        # None means "not provided" for optional arguments
+        args = {k: v for k, v in args.items() if v is not None}
+    try:
+        _VALIDATORS[name](args)
+    except fastjsonschema.JsonSchemaException as e:
+        return {"ok": False, "error": f"Invalid arguments for '{name}': {e.message}"}
+    try:
+        return fn(args)
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 
+async def _run_tool_call(call, token_info: Optional[dict] = None):
+    tool_name = call.function.name
+    raw_args = call.function.arguments or "{}"
+    try:
+        args = _json_loads(raw_args)
+    except:
+        args = {}
+    # MCP tools are blocking (DB, Google APIs, Slack); run them off the event loop
+    async with _tool_semaphore:
+        result = await asyncio.to_thread(call_tool_by_name, tool_name, args, token_info=token_info)
+    return tool_name, args, result
+
+
+_SUMMARY_TMPL = (
+    "Summary report for {doc} — {ref}\n\n"
+    "- Patients yesterday: {y}\n\n"
+    "- Patients today: {t}\n\n"
+    "- Patients tomorrow: {tm}\n\n"
+    "- Reason breakdown:\n\n"
+    "{parts}\n\n"
+    "Notification sent: {notified}"
+)
+
+
+def _format_summary_report(res: Dict[str, Any], fallback_doctor: str = "Doctor", fallback_ref: str = "") -> str:
+    """
+    Render a successful get_doctor_summary_report result, followed by the notification status.
+    Falls back to building the report from raw_stats when summary_text is missing.
+    """
+    notified = "Yes" if res.get("notification_sent", False) else "No"
+    summary_text = res.get("summary_text")
+    if summary_text and isinstance(summary_text, str) and summary_text.strip():
+        return f"{summary_text}\n\nNotification sent: {notified}"
+
+    raw = res.get("raw_stats", {})
+    doc = raw.get("doctor", fallback_doctor)
+    ref = raw.get("ref_date", fallback_ref)
+    y = raw.get("patients_yesterday", 0)
+    t = raw.get("patients_today", 0)
+    tm = raw.get("patients_tomorrow", 0)
+
+    # top_reasons preferred
+    top = raw.get("top_reasons") or []
+    if top:
+        parts = [f"• {r['reason'].title()}: {r['count']}" for r in top[:10]]
+    else:
+        rb = raw.get("reasons_breakdown", {})
+        parts = [f"• {k.title()}: {v}" for k, v in heapq.nlargest(10, rb.items(), key=lambda x: x[1])]
+
+    return _SUMMARY_TMPL.format(
+        doc=doc, ref=ref, y=y, t=t, tm=tm,
+        parts="\n".join(parts) or "• No categorized reasons available.",
+        notified=notified,
+    )
+
+
 def summarize_tool_outputs(tool_outputs: List[Dict[str, Any]]) -> str:
     """
     Create readable text from tool outputs if the model fails to produce a good summary.
@@ -162,62 +598,72 @@ def summarize_tool_outputs(tool_outputs: List[Dict[str, Any]]) -> str:
                 lines.append("Available slots:")
                 for s in slots[:6]:
                     lines.append(f" • {s['start_iso']} — {s['end_iso']}")
+        elif tool == "get_doctor_availability_many":
+            for doc_res in res.get("results", []):
+                if not doc_res.get("ok"):
+                    lines.append(doc_res.get("error", "Doctor not found"))
+                    continue
+                slots = doc_res.get("available_slots", [])
+                if not slots:
+                    lines.append(f"No available slots found for {doc_res['doctor']}.")
+                else:
+                    lines.append(f"Available slots for {doc_res['doctor']}:")
+                    for s in slots[:6]:
+                        lines.append(f" • {s['start_iso']} — {s['end_iso']}")
         elif tool == "create_appointment":
             if res.get("ok"):
                 appt_id = res.get("appointment_id")
-                cal_note = res.get("calendar", {}).get("htmlLink") or res.get("calendar", {}).get("note", "")
+                cal = res.get("calendar", {})
+                if cal.get("status") == "queued":
+                    cal_note = "A calendar invite and confirmation email are on their way."
+                else:
+                    cal_note = cal.get("htmlLink") or cal.get("note", "")
                 lines.append(f"Appointment created (id: {appt_id}). {cal_note}")
             else:
                 lines.append(f"Failed to create appointment: {res.get('error')}")
         elif tool == "get_doctor_summary_report":
             if res.get("ok"):
-                summary_text = res.get("summary_text")
-                if summary_text and isinstance(summary_text, str) and summary_text.strip():
-                    lines.append(summary_text)
-                    notified = res.get("notification_sent", False)
-                    lines.append("")
-                    lines.append(f"Notification sent: {'Yes' if notified else 'No'}")
-                else:
-                    # Build summary from raw_stats
-                    raw = res.get("raw_stats", {})
-                    doc = raw.get("doctor", "Doctor")
-                    ref = raw.get("ref_date", "")
-                    y = raw.get("patients_yesterday", 0)
-                    t = raw.get("patients_today", 0)
-                    tm = raw.get("patients_tomorrow", 0)
-
-                    # top_reasons preferred
-                    top = raw.get("top_reasons") or []
-                    if top:
-                        parts = [f"• {r['reason'].title()}: {r['count']}" for r in top[:10]]
-                    else:
-                        rb = raw.get("reasons_breakdown", {})
-                        parts = [f"• {k.title()}: {v}" for k, v in sorted(rb.items(), key=lambda x: -x[1])][:10]
-
-                    lines.append(f"Summary report for {doc} — {ref}")
-                    lines.append("")
-                    lines.append(f"- Patients yesterday: {y}")
-                    lines.append("")
-                    lines.append(f"- Patients today: {t}")
-                    lines.append("")
-                    lines.append(f"- Patients tomorrow: {tm}")
-                    lines.append("")
-                    lines.append("- Reason breakdown:")
-                    lines.append("")
-                    if parts:
-                        lines.extend(parts)
-                    else:
-                        lines.append("• No categorized reasons available.")
-                    notified = res.get("notification_sent", False)
-                    lines.append("")
-                    lines.append(f"Notification sent: {'Yes' if notified else 'No'}")
+                lines.append(_format_summary_report(res))
             else:
                 lines.append(f"Stats error: {res.get('error')}")
         else:
-            lines.append(json.dumps(res))
+            lines.append(_json_dumps(res))
     return "\n".join(lines) if lines else "No results."
 
 
+# Patterns used by the mock agent to pull entities out of a message. The name patterns
+# run against the lowercased message, so they are compiled case-sensitive.
+_DR_RE = re.compile(r"dr\.?\s+([a-z]+)")
+_DT_RE = re.compile(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2})")
+_PATIENT_RE = re.compile(r"for\s+([a-z ]+)")
+
+# Intent keywords for the mock agent, classified in a single pass over the message.
+# Each named group maps to an intent bit; the "day" group picks the reference date.
+_INTENT_RE = re.compile(
+    r"\b(?:"
+    r"(?P<availability>availability|available|slots)"
+    r"|(?P<stats>how\s+many|patients|visited)"
+    r"|(?P<booking>book(?:s|ed|ing)?|schedul(?:e|ed|ing))"
+    r"|(?P<day>tomorrow|yesterday|today)"
+    r")\b"
+)
+_INTENT_AVAILABILITY = 1
+_INTENT_STATS = 2
+_INTENT_BOOKING = 4
+_INTENT_BITS = {"availability": _INTENT_AVAILABILITY, "stats": _INTENT_STATS, "booking": _INTENT_BOOKING}
+# Day keyword -> offset from today, in priority order
+_DATE_OFFSETS = {"tomorrow": 1, "yesterday": -1, "today": 0}
+# When a stats question names several days, "yesterday" wins over "tomorrow" (the ordering
+# above is for availability and booking)
+_STATS_DAY_ORDER = ("yesterday", "tomorrow", "today")
+
+
+@lru_cache(maxsize=256)
+def _normalize_doctor(raw: Optional[str]) -> str:
+    # Doctor names come from a small set, so the formatted name is cached
+    return "Dr. Ahuja" if not raw else f"Dr. {raw.title()}"
+
+
 def mock_agent_reply(session_id: str, message: str, token_info: Optional[dict] = None) -> Dict[str, Any]:
     msg = message.lower()
     role = (token_info or {}).get("role")
@@ -225,19 +671,25 @@ def mock_agent_reply(session_id: str, message: str, token_info: Optional[dict] =
     reply = "I didn't understand. Try: 'check Dr. Ahuja availability', 'book 2025-12-02T09:00 for John', or 'how many patients yesterday'."
 
     # doctor extraction
-    m = re.search(r"dr\.?\s+([a-zA-Z]+)", message, re.IGNORECASE)
-    doctor_name = "Dr. Ahuja" if not m else f"Dr. {m.group(1).title()}"
-
-    today = datetime.utcnow().date()
-    if "tomorrow" in msg:
-        start_date = (today + timedelta(days=1)).isoformat()
-    elif "yesterday" in msg:
-        start_date = (today - timedelta(days=1)).isoformat()
-    else:
-        start_date = today.isoformat()
+    m = _DR_RE.search(msg)
+    doctor_name = _normalize_doctor(m.group(1) if m else None)
+
+    # Classify intents in one scan
+    intents = 0
+    days = set()
+    for im in _INTENT_RE.finditer(msg):
+        if im.lastgroup == "day":
+            days.add(im.group())
+        else:
+            intents |= _INTENT_BITS[im.lastgroup]
+    day_word = next((w for w in _DATE_OFFSETS if w in days), None)
+
+    today = datetime.now(timezone.utc).date()
+    today_iso = today.isoformat()
+    start_date = (today + timedelta(days=_DATE_OFFSETS[day_word])).isoformat() if day_word else today_iso
 
     # availability intent
-    if "availability" in msg or "available" in msg or "slots" in msg:
+    if intents & _INTENT_AVAILABILITY:
         res = call_tool_by_name("get_doctor_availability", {"doctor_name": doctor_name, "start_date": start_date})
         tool_calls.append({"tool": "get_doctor_availability", "args": {"doctor_name": doctor_name, "start_date": start_date}, "result": res})
         if res.get("ok"):
@@ -252,14 +704,9 @@ def mock_agent_reply(session_id: str, message: str, token_info: Optional[dict] =
             reply = f"Error: {res.get('error')}"
 
     # stats intent
-    elif "how many" in msg or "patients" in msg or "visited" in msg:
-        ref_date = None
-        if "yesterday" in msg:
-            ref_date = (today - timedelta(days=1)).isoformat()
-        elif "tomorrow" in msg:
-            ref_date = (today + timedelta(days=1)).isoformat()
-        elif "today" in msg:
-            ref_date = today.isoformat()
+    elif intents & _INTENT_STATS:
+        stats_day = next((w for w in _STATS_DAY_ORDER if w in days), None)
+        ref_date = (today + timedelta(days=_DATE_OFFSETS[stats_day])).isoformat() if stats_day else None
 
         if role != "doctor":
             reply = "Only doctors can view detailed appointment reports. Please contact your doctor for this information."
@@ -280,57 +727,19 @@ def mock_agent_reply(session_id: str, message: str, token_info: Optional[dict] =
             })
 
             if res.get("ok"):
-                summary = res.get("summary_text")
-                if summary and isinstance(summary, str) and summary.strip():
-                    notified = res.get("notification_sent", False)
-                    reply = f"{summary}\n\nNotification sent: {'Yes' if notified else 'No'}"
-                else:
-                    raw = res.get("raw_stats", {})
-                    doc = raw.get("doctor", doctor_name)
-                    ref = raw.get("ref_date", ref_date or "")
-                    y = raw.get("patients_yesterday", 0)
-                    t = raw.get("patients_today", 0)
-                    tm = raw.get("patients_tomorrow", 0)
-
-                    top = raw.get("top_reasons") or []
-                    if top:
-                        parts = [f"• {r['reason'].title()}: {r['count']}" for r in top[:10]]
-                    else:
-                        rb = raw.get("reasons_breakdown", {})
-                        parts = [f"• {k.title()}: {v}" for k, v in sorted(rb.items(), key=lambda x: -x[1])][:10]
-
-                    lines = [
-                        f"Summary report for {doc} — {ref}",
-                        "",
-                        f"- Patients yesterday: {y}",
-                        "",
-                        f"- Patients today: {t}",
-                        "",
-                        f"- Patients tomorrow: {tm}",
-                        "",
-                        "- Reason breakdown:",
-                        ""
-                    ]
-                    lines.extend(parts if parts else ["• No categorized reasons available."])
-                    notified = res.get("notification_sent", False)
-                    lines.append("")
-                    lines.append(f"Notification sent: {'Yes' if notified else 'No'}")
-
-                    reply = "\n".join(lines)
+                reply = _format_summary_report(res, fallback_doctor=doctor_name, fallback_ref=ref_date or "")
             else:
                 reply = f"Error: {res.get('error')}"
 
     # booking intent
-    elif "book" in msg or "schedule" in msg:
-        dt_match = re.search(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2})", message)
-        name_match = re.search(r"dr\.?\s+([a-zA-Z]+)", message, re.IGNORECASE)
-        patient_match = re.search(r"for\s+([A-Za-z ]+)", message, re.IGNORECASE)
-        doctor_name = "Dr. Ahuja" if not name_match else f"Dr. {name_match.group(1).title()}"
+    elif intents & _INTENT_BOOKING:
+        dt_match = _DT_RE.search(message)
+        patient_match = _PATIENT_RE.search(msg)
         patient_name = "Patient" if not patient_match else patient_match.group(1).strip().title()
 
         if dt_match:
-            start_iso = dt_match.group(1) + ":00"
-            sd = datetime.fromisoformat(start_iso)
+            sd = datetime.fromisoformat(dt_match.group(1))
+            start_iso = sd.isoformat()
             end_iso = (sd + timedelta(hours=1)).isoformat()
             patient_email = "patient@example.com"
             res = call_tool_by_name("create_appointment", {
@@ -348,8 +757,8 @@ def mock_agent_reply(session_id: str, message: str, token_info: Optional[dict] =
                 reply = f"Booking failed: {res.get('error')}"
         else:
             # show availability suggestions (for today)
-            res = call_tool_by_name("get_doctor_availability", {"doctor_name": doctor_name, "start_date": today.isoformat()})
-            tool_calls.append({"tool": "get_doctor_availability", "args": {"doctor_name": doctor_name, "start_date": today.isoformat()}, "result": res})
+            res = call_tool_by_name("get_doctor_availability", {"doctor_name": doctor_name, "start_date": today_iso})
+            tool_calls.append({"tool": "get_doctor_availability", "args": {"doctor_name": doctor_name, "start_date": today_iso}, "result": res})
             if res.get("ok"):
                 slots = res.get("available_slots", [])[:5]
                 if slots:
@@ -363,14 +772,8 @@ def mock_agent_reply(session_id: str, message: str, token_info: Optional[dict] =
     return {"reply": reply, "tool_calls": tool_calls}
 
 
-# OpenAI agent flow 
-def openai_agent_reply(session_id: str, user_message: str, token_info: Optional[dict] = None):
-    if not openai_client:
-        return {"reply": "OpenAI client not initialized; falling back to mock.", "tool_calls": []}
-
-    history = get_session_history(session_id)
-
-    system_prompt = (
+# Agent instructions, sent as the first message of every OpenAI request
+SYSTEM_PROMPT = (
     "You are an AI assistant for a medical appointment scheduling system. "
     "Your job is to help users check doctor availability, create appointments, "
     "and retrieve system statistics using tool calls. You must follow strict rules "
@@ -422,101 +825,249 @@ def openai_agent_reply(session_id: str, user_message: str, token_info: Optional[
     "- Never fabricate tool responses.\n"
     "- The final message after tool execution should be a clean summary.\n"
 )
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
 
-    messages = [
-        {"role": "system", "content": system_prompt}
-    ]
+
+def _agent_messages(history: Sequence[Msg], user_message: str, token_info: Optional[dict] = None) -> List[Dict[str, Any]]:
+    """
+    System prompt, doctor identity (for doctors), trimmed history and the user message, as sent
+    for the tool-selection completion.
+    """
+    messages = [_SYSTEM_MESSAGE]
 
     if token_info and token_info.get("role") == "doctor" and token_info.get("doctor_name"):
         messages.append({"role": "system", "content": f"You are acting on behalf of {token_info['doctor_name']}. Use this identity when appropriate."})
 
-    # Append only user/assistant history
-    for item in history:
-        if item["role"] in ("user", "assistant"):
-            messages.append({"role": item["role"], "content": item["content"]})
+    # History only holds user/assistant turns and usually already ends with this user message
+    messages.extend({"role": m.role, "content": m.content} for m in history)
+    if not history or history[-1].role != "user" or history[-1].content != user_message:
+        messages.append({"role": "user", "content": user_message})
+    return messages
 
-    messages.append({"role": "user", "content": user_message})
 
-    tools = build_tools_schema()
+# OpenAI agent flow 
+async def _openai_tool_phase(session_id: str, user_message: str, token_info: Optional[dict] = None):
+    """
+    Run the tool-selection completion and execute any tools the model asked for.
+    Returns (messages, message, tool_outputs); tool_outputs is None when the model answered directly.
+    """
+    history = _trim_history(await get_session_history(session_id))
+    messages = _agent_messages(history, user_message, token_info)
+
     role = (token_info or {}).get("role")
-    if role != "doctor":
-        tools = [
-            t for t in tools
-            if not (t.get("function", {}).get("name") == "get_doctor_summary_report")
-        ]
+    tools = TOOLS_SCHEMA if role == "doctor" else _PATIENT_TOOLS_SCHEMA
 
+    choice = await _first_choice(
+        model="gpt-4.1-mini",
+        messages=messages,
+        tools=tools,
+        tool_choice="auto",
+        temperature=0.2,
+    )
+    message = choice.message
+
+    if not (hasattr(message, "tool_calls") and getattr(message, "tool_calls")):
+        return messages, message, None
+
+    # The tool results must follow the assistant message that requested them
+    messages.append(message)
+
+    tool_outputs = []
+    # Execute the requested tool calls concurrently; gather keeps the model's order
+    results = await asyncio.gather(*[_run_tool_call(call, token_info) for call in message.tool_calls])
+    for call, (tool_name, args, result) in zip(message.tool_calls, results):
+        tool_outputs.append({"tool": tool_name, "args": args, "result": result})
+
+        # Append the tool output back to the LLM conversation in the required format
+        messages.append({
+            "role": "tool",
+            "tool_call_id": call.id,
+            "content": _json_dumps(result)
+        })
+    return messages, message, tool_outputs
+
+
+def _is_notification_report(tool_outputs: List[Dict[str, Any]]) -> bool:
+    """
+    A doctor report pushed to Slack is fire-and-forget: the tool has already built the
+    summary text and delivered it, so the reply needs no follow-up completion.
+    """
+    if len(tool_outputs) != 1:
+        return False
+    entry = tool_outputs[0]
+    # The model's arguments are parsed JSON and need not be an object
+    return (
+        entry["tool"] == "get_doctor_summary_report"
+        and isinstance(entry.get("args"), dict)
+        and isinstance(entry.get("result"), dict)
+        and entry["args"].get("send_notification", True)
+        and bool(entry["result"].get("ok"))
+    )
+
+
+async def _tool_reply(messages: List[Any], tool_outputs: List[Dict[str, Any]]) -> str:
+    """
+    Reply text once tools have run: the model's follow-up over `messages` (which end with the
+    tool results), or the local summary if that fails or isn't needed.
+    """
+    if _is_notification_report(tool_outputs):
+        return summarize_tool_outputs(tool_outputs)
     try:
-        resp = openai_client.chat.completions.create(
-            model="gpt-4.1-mini",
+        final_resp = await _chat_completion(
+            model=_SUMMARIZE_MODEL,
             messages=messages,
-            tools=tools,
-            tool_choice="auto",
-            temperature=0.2,
+            temperature=0.25,
         )
+        final_message = final_resp.choices[0].message
+        final_text = final_message.content if getattr(final_message, "content", None) else None
     except Exception as e:
-        return {"reply": f"OpenAI error: {e} (falling back to mock)", "tool_calls": []}
+        final_text = None
 
-    choice = resp.choices[0]
-    message = choice.message
+    if not final_text or final_text.strip() == "" or final_text.strip().lower().startswith("tool result"):
+        final_text = summarize_tool_outputs(tool_outputs)
+    return final_text
 
-    # If model requested tool_calls
-    if hasattr(message, "tool_calls") and getattr(message, "tool_calls"):
-        tool_outputs = []
-        # For each tool call the model asked for, execute it
-        for call in message.tool_calls:
-            tool_name = call.function.name
-            raw_args = call.function.arguments or "{}"
-            try:
-                args = json.loads(raw_args)
-            except:
-                args = {}
-            result = call_tool_by_name(tool_name, args, token_info=token_info)
-            tool_outputs.append({"tool": tool_name, "args": args, "result": result})
 
-            # Append the tool output back to the LLM conversation in the required format
-            messages.append({
-                "role": "tool",
-                "tool_call_id": call.id,
-                "content": json.dumps(result)
-            })
+async def openai_agent_reply(session_id: str, user_message: str, token_info: Optional[dict] = None):
+    if not _get_openai_client():
+        return {"reply": "OpenAI client not initialized; falling back to mock.", "tool_calls": [], "error": True}
 
-        try:
-            final_resp = openai_client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=messages,
-                temperature=0.25,
-            )
-            final_message = final_resp.choices[0].message
-            final_text = final_message.content if getattr(final_message, "content", None) else None
-        except Exception as e:
-            final_text = None
-
-        if not final_text or final_text.strip() == "" or final_text.strip().lower().startswith("tool result"):
-            final_text = summarize_tool_outputs(tool_outputs)
+    try:
+        messages, message, tool_outputs = await _openai_tool_phase(session_id, user_message, token_info=token_info)
+    except Exception as e:
+        return {"reply": f"OpenAI error: {e} (falling back to mock)", "tool_calls": [], "error": True}
 
-        # Save assistant reply and return
-        append_session(session_id, "assistant", final_text)
-        return {"reply": final_text, "tool_calls": tool_outputs}
+    # If model requested tool_calls
+    if tool_outputs is not None:
+        return {"reply": await _tool_reply(messages, tool_outputs), "tool_calls": tool_outputs}
 
     # No tool call, return model's direct content
     assistant_text = message.content if getattr(message, "content", None) else ""
-    append_session(session_id, "assistant", assistant_text)
     return {"reply": assistant_text, "tool_calls": []}
 
 
-def process_user_message(session_id: Optional[str], message: str, token_info: Optional[dict] = None) -> Dict[str, Any]:
+async def openai_agent_reply_stream(session_id: str, user_message: str, token_info: Optional[dict] = None):
+    """
+    Streaming variant of openai_agent_reply.
+    Yields {"type": "delta", "content": ...} events, then a final {"type": "done", "reply": ..., "tool_calls": ...}.
+    """
+    if not _get_openai_client():
+        reply = "OpenAI client not initialized; falling back to mock."
+        yield {"type": "delta", "content": reply}
+        yield {"type": "done", "reply": reply, "tool_calls": []}
+        return
+
+    try:
+        messages, message, tool_outputs = await _openai_tool_phase(session_id, user_message, token_info=token_info)
+    except Exception as e:
+        reply = f"OpenAI error: {e} (falling back to mock)"
+        yield {"type": "delta", "content": reply}
+        yield {"type": "done", "reply": reply, "tool_calls": []}
+        return
+
+    if tool_outputs is None:
+        assistant_text = message.content if getattr(message, "content", None) else ""
+        yield {"type": "delta", "content": assistant_text}
+        yield {"type": "done", "reply": assistant_text, "tool_calls": []}
+        return
+
+    if _is_notification_report(tool_outputs):
+        final_text = summarize_tool_outputs(tool_outputs)
+        yield {"type": "delta", "content": final_text}
+        yield {"type": "done", "reply": final_text, "tool_calls": tool_outputs}
+        return
+
+    # Forward the summary tokens as they arrive instead of waiting for the full completion
+    final_text = ""
+    try:
+        stream = await _chat_completion(
+            model=_SUMMARIZE_MODEL,
+            messages=messages,
+            temperature=0.25,
+            stream=True,
+        )
+        async for chunk in stream:
+            piece = chunk.choices[0].delta.content if chunk.choices else None
+            if piece:
+                final_text += piece
+                yield {"type": "delta", "content": piece}
+    except Exception as e:
+        # Whatever streamed so far is kept; an empty reply falls back to the tool summary below
+        print("Streaming OpenAI summary failed:", e)
+
+    if not final_text.strip():
+        final_text = summarize_tool_outputs(tool_outputs)
+        yield {"type": "delta", "content": final_text}
+    yield {"type": "done", "reply": final_text, "tool_calls": tool_outputs}
+
+
+# Small talk answered without running an agent. Words that can confirm a pending action
+# ("ok", "yes") are deliberately absent: the agent asks for confirmation before booking.
+_GREETING = "Hello! How can I help you today? You can check a doctor's availability, book an appointment, or ask for a report."
+_YOURE_WELCOME = "You're welcome! Let me know if there's anything else I can do."
+_TRIVIAL = {
+    "hi": _GREETING,
+    "hello": _GREETING,
+    "hey": _GREETING,
+    "thanks": _YOURE_WELCOME,
+    "thank you": _YOURE_WELCOME,
+    "bye": "Goodbye! Take care.",
+}
+
+
+# Recent OpenAI replies, so a retried or repeated question skips the round-trip
+REPLY_CACHE_TTL = 120
+_REPLY_CACHE: "TTLCache[tuple, Dict[str, Any]]" = TTLCache(maxsize=5000, ttl=REPLY_CACHE_TTL)
+
+
+def _reply_cache_key(session_id: str, message: str, history: Sequence[Msg], token_info: Optional[dict] = None) -> tuple:
+    # The assistant turn before the question is part of the key: short answers like "no" or
+    # "tomorrow" mean different things depending on what they reply to. Trailing asks of this
+    # same message (the current one, earlier repeats and their replies) are skipped, so a
+    # repeat or retry is keyed on the same context as the first ask.
+    earlier = list(history)
+    while earlier:
+        if earlier[-1].role == "user" and earlier[-1].content == message:
+            earlier.pop()
+        elif len(earlier) >= 2 and earlier[-1].role == "assistant" and earlier[-2].role == "user" and earlier[-2].content == message:
+            del earlier[-2:]
+        else:
+            break
+    last_reply = next((m.content for m in reversed(earlier) if m.role == "assistant"), "")
+    h = hashlib.blake2b(digest_size=16)
+    h.update(last_reply.encode("utf-8"))
+    h.update(b"\0")
+    h.update(message.encode("utf-8"))
+    return session_id, (token_info or {}).get("role"), h.digest()
+
+
+def _trivial_reply(message: str) -> Optional[str]:
+    return _TRIVIAL.get(message.strip().lower().rstrip("!.?"))
+
+
+async def process_user_message(session_id: Optional[str], message: str, token_info: Optional[dict] = None) -> Dict[str, Any]:
     if not session_id:
         session_id = create_session()
-    append_session(session_id, "user", message)
+    await append_session(session_id, "user", message)
 
-    if USE_OPENAI and openai_client:
-        out = openai_agent_reply(session_id, message, token_info=token_info)
+    trivial = _trivial_reply(message)
+    if trivial is not None:
+        out = {"reply": trivial, "tool_calls": []}
+        mode = "trivial"
+    elif USE_OPENAI and _get_openai_client():
+        key = _reply_cache_key(session_id, message, await get_session_history(session_id), token_info)
+        out = _REPLY_CACHE.get(key)
+        if out is None:
+            out = await openai_agent_reply(session_id, message, token_info=token_info)
+            # Only plain answers are reused; tool calls may have side effects (bookings)
+            if not out.get("tool_calls") and not out.get("error"):
+                _REPLY_CACHE[key] = out
         mode = "openai"
     else:
-        out = mock_agent_reply(session_id, message, token_info=token_info) if 'mock_agent_reply' in globals() else mock_agent_reply(session_id, message)
+        out = await asyncio.to_thread(mock_agent_reply, session_id, message, token_info=token_info)
         mode = "mock"
 
-    append_session(session_id, "assistant", out.get("reply", ""))
+    await append_session(session_id, "assistant", out.get("reply", ""))
     return {
         "ok": True,
         "session_id": session_id,
@@ -525,6 +1076,307 @@ def process_user_message(session_id: Optional[str], message: str, token_info: Op
         "mode": mode
     }
 
+async def process_user_message_stream(session_id: Optional[str], message: str, token_info: Optional[dict] = None):
+    """
+    Like process_user_message, but yields events as the reply is produced:
+    a "session" event, "delta" events with reply text, and a final "done" event.
+    """
+    if not session_id:
+        session_id = create_session()
+    await append_session(session_id, "user", message)
+    yield {"type": "session", "session_id": session_id}
+
+    trivial = _trivial_reply(message)
+    if trivial is not None:
+        events = _canned_reply_events(trivial)
+        mode = "trivial"
+    elif USE_OPENAI and _get_openai_client():
+        events = openai_agent_reply_stream(session_id, message, token_info=token_info)
+        mode = "openai"
+    else:
+        events = _mock_reply_events(session_id, message, token_info=token_info)
+        mode = "mock"
+
+    async for event in events:
+        if event["type"] == "done":
+            await append_session(session_id, "assistant", event["reply"])
+            event = {**event, "session_id": session_id, "mode": mode}
+        yield event
+
+
+async def _canned_reply_events(reply: str):
+    yield {"type": "delta", "content": reply}
+    yield {"type": "done", "reply": reply, "tool_calls": []}
+
+
+async def _mock_reply_events(session_id: str, message: str, token_info: Optional[dict] = None):
+    out = await asyncio.to_thread(mock_agent_reply, session_id, message, token_info=token_info)
+    yield {"type": "delta", "content": out["reply"]}
+    yield {"type": "done", "reply": out["reply"], "tool_calls": out["tool_calls"]}
+
+# Bulk processing
+_PACKED_INSTRUCTIONS = (
+    "You will receive several independent user requests as a JSON array of "
+    "{\"index\", \"message\"} objects. Handle each one separately, calling tools as needed. "
+    "Respond with a JSON object of the form "
+    "{\"replies\": [{\"index\": <index>, \"reply\": <reply text>}, ...]} covering every request."
+)
+
+
+async def _packed_openai_replies(items: List[tuple], tool_outputs: List[Dict[str, Any]], token_info: Optional[dict] = None) -> Dict[int, str]:
+    """
+    Answer several messages with one completion (plus one follow-up if tools were used).
+    Returns {index: reply} for the entries the model answered. Tools that ran are appended
+    to tool_outputs as soon as they finish, so the caller sees them even if a later step fails.
+    """
+    messages = [_SYSTEM_MESSAGE, {"role": "system", "content": _PACKED_INSTRUCTIONS}]
+    if token_info and token_info.get("role") == "doctor" and token_info.get("doctor_name"):
+        messages.append({"role": "system", "content": f"You are acting on behalf of {token_info['doctor_name']}. Use this identity when appropriate."})
+    messages.append({"role": "user", "content": _json_dumps([{"index": i, "message": msg} for i, (_, msg) in enumerate(items)])})
+
+    role = (token_info or {}).get("role")
+    tools = TOOLS_SCHEMA if role == "doctor" else _PATIENT_TOOLS_SCHEMA
+    choice = await _first_choice(
+        model="gpt-4.1-mini",
+        messages=messages,
+        tools=tools,
+        tool_choice="auto",
+        temperature=0.2,
+    )
+    message = choice.message
+
+    if getattr(message, "tool_calls", None):
+        messages.append(message)
+        results = await asyncio.gather(*[_run_tool_call(call, token_info) for call in message.tool_calls])
+        for call, (tool_name, args, result) in zip(message.tool_calls, results):
+            tool_outputs.append({"tool": tool_name, "args": args, "result": result})
+            messages.append({"role": "tool", "tool_call_id": call.id, "content": _json_dumps(result)})
+        final = await _chat_completion(
+            model=_SUMMARIZE_MODEL,
+            messages=messages,
+            temperature=0.25,
+            response_format={"type": "json_object"},
+        )
+        content = final.choices[0].message.content
+    else:
+        content = message.content
+
+    replies = {}
+    try:
+        for entry in _json_loads(content or "{}").get("replies", []):
+            if isinstance(entry, dict) and isinstance(entry.get("index"), int) and entry.get("reply"):
+                replies[entry["index"]] = str(entry["reply"])
+    except (ValueError, AttributeError):
+        pass
+    return replies
+
+
+# Submitted Batch API jobs: who sent them and which session each request belongs to.
+# Kept in Redis when configured so any worker can collect the results.
+BATCH_JOB_TTL = int(os.getenv("OPENAI_BATCH_JOB_TTL", str(2 * 24 * 3600)))
+_batch_jobs: "TTLCache[str, Dict[str, Any]]" = TTLCache(maxsize=1000, ttl=BATCH_JOB_TTL)
+_collecting_batches: Set[str] = set()
+
+
+async def _save_batch_job(batch_id: str, job: Dict[str, Any]):
+    r = get_redis()
+    if r is None:
+        _batch_jobs[batch_id] = job
+    else:
+        await r.set(f"batch:{batch_id}", _json_dumps(job), ex=BATCH_JOB_TTL)
+
+
+async def _load_batch_job(batch_id: str) -> Optional[Dict[str, Any]]:
+    r = get_redis()
+    if r is None:
+        return _batch_jobs.get(batch_id)
+    raw = await r.get(f"batch:{batch_id}")
+    return _json_loads(raw) if raw else None
+
+
+async def _claim_batch_job(batch_id: str) -> bool:
+    """Only one caller may collect a batch; its tools must run once."""
+    r = get_redis()
+    if r is None:
+        if batch_id in _collecting_batches:
+            return False
+        _collecting_batches.add(batch_id)
+        return True
+    return bool(await r.set(f"batch:{batch_id}:collect", 1, nx=True, ex=600))
+
+
+async def _release_batch_job(batch_id: str):
+    r = get_redis()
+    if r is None:
+        _collecting_batches.discard(batch_id)
+    else:
+        await r.delete(f"batch:{batch_id}:collect")
+
+
+async def _submit_openai_batch(items: List[tuple], token_info: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Queue one chat completion per message through the OpenAI Batch API (asynchronous, lower cost).
+    Each message is added to its session (a new one if none was given) right away; the replies
+    are added when the results are collected with fetch_openai_batch.
+    """
+    role = (token_info or {}).get("role")
+    tools = TOOLS_SCHEMA if role == "doctor" else _PATIENT_TOOLS_SCHEMA
+    requests = []
+    lines = []
+    for i, (session_id, msg) in enumerate(items):
+        if not session_id:
+            session_id = create_session()
+        await append_session(session_id, "user", msg)
+        history = _trim_history(await get_session_history(session_id))
+        requests.append({"session_id": session_id, "message": msg})
+        lines.append(_json_dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4.1-mini",
+                "messages": _agent_messages(history, msg, token_info),
+                "tools": tools,
+                "temperature": 0.2,
+            },
+        }))
+
+    client = _get_openai_client()
+    upload = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=upload.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    await _save_batch_job(batch.id, {"token_info": token_info, "requests": requests})
+    return {"batch_id": batch.id, "status": batch.status, "session_ids": [r["session_id"] for r in requests]}
+
+
+async def _batch_reply(request: Dict[str, Any], message: Dict[str, Any], token_info: Optional[dict]) -> Dict[str, Any]:
+    """Turn one Batch API completion into a reply, running the tools it asked for."""
+    tool_calls = message.get("tool_calls") or []
+    if not tool_calls:
+        return {"reply": message.get("content") or "", "tool_calls": []}
+
+    calls = [
+        SimpleNamespace(id=c["id"], function=SimpleNamespace(name=c["function"]["name"], arguments=c["function"].get("arguments")))
+        for c in tool_calls
+    ]
+    messages = [_SYSTEM_MESSAGE, {"role": "user", "content": request["message"]}, message]
+    tool_outputs = []
+    results = await asyncio.gather(*[_run_tool_call(call, token_info) for call in calls])
+    for call, (tool_name, args, result) in zip(calls, results):
+        tool_outputs.append({"tool": tool_name, "args": args, "result": result})
+        messages.append({"role": "tool", "tool_call_id": call.id, "content": _json_dumps(result)})
+    return {"reply": await _tool_reply(messages, tool_outputs), "tool_calls": tool_outputs}
+
+
+async def fetch_openai_batch(batch_id: str, token_info: Optional[dict] = None) -> Optional[Dict[str, Any]]:
+    """
+    Status of a batch submitted by this user, or its results once OpenAI has finished it.
+    The first collection runs the requested tools and appends each reply to its session;
+    later calls return the stored results. None if the batch is unknown or not the caller's.
+    """
+    job = await _load_batch_job(batch_id)
+    if job is None or (job["token_info"] or {}).get("email") != (token_info or {}).get("email"):
+        return None
+    if "results" in job:
+        return {"ok": True, "mode": "batch", "batch_id": batch_id, "status": "completed", "results": job["results"]}
+
+    client = _get_openai_client()
+    if client is None:
+        return {"ok": False, "mode": "batch", "batch_id": batch_id, "error": "OpenAI client not initialized"}
+    try:
+        batch = await client.batches.retrieve(batch_id)
+    except Exception as e:
+        return {"ok": False, "mode": "batch", "batch_id": batch_id, "error": f"OpenAI batch error: {e}"}
+    if batch.status != "completed":
+        return {"ok": True, "mode": "batch", "batch_id": batch_id, "status": batch.status}
+    if not await _claim_batch_job(batch_id):
+        return {"ok": True, "mode": "batch", "batch_id": batch_id, "status": "collecting"}
+
+    try:
+        messages_by_index = {}
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = _json_loads(line)
+                try:
+                    messages_by_index[int(entry["custom_id"])] = entry["response"]["body"]["choices"][0]["message"]
+                except (KeyError, IndexError, TypeError, ValueError):
+                    continue
+
+        results = []
+        for i, request in enumerate(job["requests"]):
+            message = messages_by_index.get(i)
+            if message is None:
+                out = {"reply": "No reply was produced for this message.", "tool_calls": [], "error": True}
+            else:
+                out = await _batch_reply(request, message, job["token_info"])
+            await append_session(request["session_id"], "assistant", out["reply"])
+            result = {"ok": True, "session_id": request["session_id"], "reply": out["reply"], "tool_calls": out["tool_calls"], "mode": "batch"}
+            if out.get("error"):
+                result["error"] = True
+            results.append(result)
+
+        job["results"] = results
+        await _save_batch_job(batch_id, job)
+    finally:
+        await _release_batch_job(batch_id)
+    return {"ok": True, "mode": "batch", "batch_id": batch_id, "status": "completed", "results": results}
+
+
+async def process_user_messages_batch(items: List[tuple], urgency: str = "low-latency", token_info: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Handle several (session_id, message) pairs at once.
+    "low-latency" packs the messages without a session into a single prompt and answers
+    immediately; messages that continue a session need its history and go through
+    process_user_message one by one. Tools run for the packed prompt can't be attributed to a
+    single message, so they are returned once as the top-level "tool_calls".
+    "batch" queues everything with the OpenAI Batch API and returns the batch id and the
+    session of each message; fetch_openai_batch collects the replies. Without OpenAI each
+    message is processed individually.
+    """
+    if not (USE_OPENAI and _get_openai_client()):
+        results = [await process_user_message(sid, msg, token_info=token_info) for sid, msg in items]
+        return {"ok": True, "mode": "mock", "results": results}
+
+    if urgency == "batch":
+        try:
+            out = await _submit_openai_batch(items, token_info=token_info)
+        except Exception as e:
+            return {"ok": False, "mode": "batch", "error": f"OpenAI batch error: {e}"}
+        return {"ok": True, "mode": "batch", **out}
+
+    packed = [(i, msg) for i, (session_id, msg) in enumerate(items) if not session_id]
+    replies: Dict[int, str] = {}
+    tool_outputs: List[Dict[str, Any]] = []
+    if packed:
+        try:
+            by_position = await _packed_openai_replies(packed, tool_outputs, token_info=token_info)
+            replies = {packed[pos][0]: reply for pos, reply in by_position.items() if 0 <= pos < len(packed)}
+        except Exception as e:
+            print("Packed OpenAI request failed:", e)
+
+    results = []
+    for i, (session_id, msg) in enumerate(items):
+        if i in replies:
+            session_id = create_session()
+            await append_session(session_id, "user", msg)
+            await append_session(session_id, "assistant", replies[i])
+            results.append({"ok": True, "session_id": session_id, "reply": replies[i], "tool_calls": [], "mode": "openai"})
+        elif session_id or not tool_outputs:
+            results.append(await process_user_message(session_id, msg, token_info=token_info))
+        else:
+            # Tools already ran for the packed prompt (possibly booking for this very message);
+            # answering it again could repeat them, so report the gap instead
+            results.append({"ok": False, "session_id": None, "reply": "No reply was produced for this message; see tool_calls for what was done.", "tool_calls": [], "mode": "openai", "error": True})
+    return {"ok": True, "mode": "openai", "results": results, "tool_calls": tool_outputs}
+
+
 # Debug helper
-def dump_session(session_id: str) -> Dict[str, Any]:
-    return {"session_id": session_id, "history": get_session_history(session_id)}
+async def dump_session(session_id: str) -> Dict[str, Any]:
+    history = [m._asdict() for m in await get_session_history(session_id)]
+    return {"session_id": session_id, "history": history}
@@ -0,0 +1,118 @@
+import os
+from typing import Dict, Optional
+from cachetools import TTLCache
+
+from app.db import get_redis
+
+# Login tokens expire after TOKEN_TTL seconds of existence
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", "86400"))
+MAX_TOKENS = int(os.getenv("MAX_TOKENS", "10000"))
+
+
+class TokenStore:
+    """
+    Maps auth tokens to {"email", "role", "doctor_name"}.
+    A bounded in-process TTL cache is consulted first; when REDIS_URL is set, tokens are
+    also kept in Redis hashes so every worker can resolve them.
+    """
+
+    FIELDS = ("email", "role", "doctor_name")
+
+    def __init__(self, maxsize: int = MAX_TOKENS, ttl: int = TOKEN_TTL):
+        self.ttl = ttl
+        self._local: "TTLCache[str, Dict[str, Optional[str]]]" = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return f"tok:{token}"
+
+    async def put(self, token: str, info: Dict[str, Optional[str]]):
+        self._local[token] = info
+        r = get_redis()
+        if r is not None:
+            key = self._key(token)
+            # Redis hashes can't hold None; an empty string stands in for it
+            async with r.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={f: info.get(f) or "" for f in self.FIELDS})
+                pipe.expire(key, self.ttl)
+                await pipe.execute()
+
+    async def get(self, token: str) -> Optional[Dict[str, Optional[str]]]:
+        info = self._local.get(token)
+        if info is not None:
+            return info
+        r = get_redis()
+        if r is None:
+            return None
+        raw = await r.hgetall(self._key(token))
+        if not raw:
+            return None
+        decoded = {k.decode() if isinstance(k, bytes) else k: v.decode() if isinstance(v, bytes) else v for k, v in raw.items()}
+        info = {f: decoded.get(f) or None for f in self.FIELDS}
+        self._local[token] = info
+        return info
+
+
+token_store = TokenStore()
+
+
+def _error_body(detail: str) -> bytes:
+    return ('{"detail":"%s"}' % detail).encode()
+
+
+# Pre-encoded error responses, matching FastAPI's HTTPException body
+_MISSING_TOKEN = (401, _error_body("X-AUTH header required"))
+_INVALID_TOKEN = (401, _error_body("Invalid token"))
+_ROLE_MISMATCH = (403, _error_body("Role mismatch"))
+
+
+class AuthASGIMiddleware:
+    """
+    Resolves the X-AUTH token (and optional X-ROLE check) for protected HTTP paths and
+    stores the token info in scope["state"]["token_info"] for the endpoint to read.
+    Requests that fail are answered here without reaching the app.
+    """
+
+    def __init__(self, app, protected_paths=(), protected_prefixes=()):
+        self.app = app
+        self.protected_paths = frozenset(protected_paths)
+        self.protected_prefixes = tuple(protected_prefixes)
+
+    def _is_protected(self, path: str) -> bool:
+        return path in self.protected_paths or (bool(self.protected_prefixes) and path.startswith(self.protected_prefixes))
+
+    async def __call__(self, scope, receive, send):
+        # CORS preflights carry no credentials and are answered by the CORS middleware
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or not self._is_protected(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        x_auth = x_role = None
+        for name, value in scope["headers"]:
+            if name == b"x-auth":
+                x_auth = value.decode("latin-1")
+            elif name == b"x-role":
+                x_role = value.decode("latin-1")
+
+        if not x_auth:
+            await self._reject(send, *_MISSING_TOKEN)
+            return
+        info = await token_store.get(x_auth)
+        if not info:
+            await self._reject(send, *_INVALID_TOKEN)
+            return
+        if x_role and info.get("role") != x_role:
+            await self._reject(send, *_ROLE_MISMATCH)
+            return
+
+        scope.setdefault("state", {})["token_info"] = info
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    async def _reject(send, status: int, body: bytes):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
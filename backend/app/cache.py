@@ -0,0 +1,78 @@
+import os
+import json
+import time
+from typing import Any, Awaitable, Callable
+from cachetools import LRUCache
+
+from app.db import get_redis
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Once an entry's TTL has passed it is recomputed, but it is kept for STALE_TTL more
+# seconds so it can still be served if recomputing fails (e.g. the database is down).
+STALE_TTL = int(os.getenv("RESPONSE_CACHE_STALE_TTL", "600"))
+
+# key -> (value, generated_at, discard_at); used when Redis is not configured
+_local: "LRUCache[str, tuple]" = LRUCache(maxsize=1024)
+
+
+def _redis_key(key: str) -> str:
+    return f"resp:{key}"
+
+
+def _dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson is not None else json.dumps(obj)
+
+
+def _loads(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+async def _load(key: str):
+    r = get_redis()
+    if r is None:
+        entry = _local.get(key)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+    try:
+        raw = await r.get(_redis_key(key))
+    except Exception as e:
+        print("Response cache read failed:", e)
+        return None
+    return tuple(_loads(raw)) if raw else None
+
+
+async def _store(key: str, value: Any, ttl: int):
+    now = time.time()
+    r = get_redis()
+    if r is None:
+        _local[key] = (value, now, now + ttl + STALE_TTL)
+        return
+    try:
+        await r.set(_redis_key(key), _dumps([value, now]), ex=ttl + STALE_TTL)
+    except Exception as e:
+        print("Response cache write failed:", e)
+
+
+async def cached_response(key: str, ttl: int, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Return the cached JSON-serializable value for key if it is younger than ttl seconds,
+    otherwise await compute() and cache its result. If compute() raises and a stale
+    entry is still held, the stale value is returned instead.
+    """
+    entry = await _load(key)
+    if entry is not None and time.time() - entry[1] < ttl:
+        return entry[0]
+    try:
+        value = await compute()
+    except Exception as e:
+        if entry is None:
+            raise
+        print(f"Serving stale response for {key}:", e)
+        return entry[0]
+    await _store(key, value, ttl)
+    return value
@@ -1,5 +1,7 @@
+from contextlib import contextmanager
+from typing import Iterator, Optional
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 import os
 from dotenv import load_dotenv
 
@@ -7,8 +9,70 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, echo=True)
+# Connection pool sizing per worker process. Tool calls run concurrently in threads, so the
+# pool should cover the number of tools in flight (ai.TOOL_CONCURRENCY) plus API requests.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+pool_options = {}
+if not DATABASE_URL.startswith("sqlite"):
+    pool_options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        # Drop connections the server closed while idle instead of failing the request
+        "pool_pre_ping": True,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    print(f"DB pool: size={DB_POOL_SIZE} max_overflow={DB_MAX_OVERFLOW} recycle={DB_POOL_RECYCLE}s")
+
+engine = create_engine(DATABASE_URL, echo=True, **pool_options)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+
+@contextmanager
+def scoped_session(db: Optional[Session] = None) -> Iterator[Session]:
+    """
+    Yield db if the caller already has a session, otherwise open one and close it on exit.
+    """
+    if db is not None:
+        yield db
+        return
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_db():
+    """
+    FastAPI dependency yielding one session per request. The session only checks out a
+    connection on first use, so endpoints that answer from cache don't touch the pool.
+    """
+    with scoped_session() as db:
+        yield db
+
+REDIS_URL = os.getenv("REDIS_URL")
+_redis = None
+
+
+def get_redis():
+    """
+    Shared redis.asyncio client, or None when REDIS_URL is not configured.
+    """
+    global _redis
+    if _redis is None and REDIS_URL:
+        import redis.asyncio as redis
+        _redis = redis.from_url(REDIS_URL)
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
@@ -1,8 +1,15 @@
+from sqlalchemy.schema import CreateIndex
 from .db import Base, engine
 from . import models 
 
 def init():
     Base.metadata.create_all(bind=engine)
+    # create_all skips tables that already exist; add indexes introduced since then.
+    # IF NOT EXISTS rather than checkfirst, which can't see expression indexes on SQLite.
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
     print("✅ Tables created successfully")
 
 if __name__ == "__main__":
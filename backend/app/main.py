@@ -1,14 +1,28 @@
 from app.mcp import tools
-from app.db import SessionLocal
+from app.db import close_redis, get_db
 from app.models import Doctor
+from app.auth import AuthASGIMiddleware, token_store
+from app.cache import cached_response
 from app import ai
-from fastapi import FastAPI, HTTPException, Header, Depends
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
-import uuid
-
-app = FastAPI(title = "MCP BACKEND")
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from sqlalchemy.orm import Session
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from typing import List, Literal, Optional
+import os
+import secrets
+import asyncio
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson serializes responses in C; fall back to the stdlib encoder when it is missing
+app = FastAPI(title = "MCP BACKEND", default_response_class=ORJSONResponse if orjson is not None else JSONResponse)
 
 DOCTOR_EMAIL_MAP = {
     "mehta@clinic.com": "Dr. Mehta",
@@ -18,21 +32,48 @@ DOCTOR_EMAIL_MAP = {
     "joshi@clinic.com": "Dr. Joshi",
     "ahuja@clinic.com": "Dr. Ahuja",
 }
+# Lookup tables for /auth/login, normalized once at import
+_DOCTOR_EMAIL_MAP_NORM = {k.strip().lower(): v for k, v in DOCTOR_EMAIL_MAP.items()}
+_VALID_ROLES = frozenset(("patient", "doctor"))
+
+# Token check for authenticated endpoints; endpoints read request.state.token_info.
+# Added before CORS so that CORS stays outermost and also decorates auth errors.
+app.add_middleware(
+    AuthASGIMiddleware,
+    protected_paths=("/api/ai", "/api/ai/stream", "/api/ai/batch", "/doctor/report"),
+    protected_prefixes=("/api/ai/batch/",),
+)
 
-TOKENS = {}
+# Compress larger JSON bodies such as slot lists; SSE responses are left uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-# CORS middleware - allows frontend to make requests
+# CORS middleware - allows frontend to make requests.
+# Only the methods and headers the frontend sends, so preflights don't echo arbitrary headers.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],  
+    allow_origins=("http://localhost:3000", "http://127.0.0.1:3000"),
     allow_credentials=True,
-    allow_methods=["*"],  
-    allow_headers=["*"],  
+    allow_methods=("GET", "POST"),
+    allow_headers=("X-AUTH", "X-ROLE", "Content-Type", "Accept"),
 )
 
+@app.on_event("startup")
+async def startup():
+    # Fetching the tiktoken vocabulary can take seconds; start it before the first chat request
+    ai.preload_encoding()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await ai.aclose()
+    await close_redis()
+    await asyncio.to_thread(tools.shutdown_background)
+
+# Liveness probes hit this constantly; serve prebuilt bytes and skip response serialization
+_HEALTH_RESPONSE = Response(b'{"ok":true}', media_type="application/json")
+
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return _HEALTH_RESPONSE
 
 # Simple login endpoint
 class LoginRequest(BaseModel):
@@ -45,47 +86,119 @@ class LoginResponse(BaseModel):
     doctor_name: Optional[str] = None
 
 @app.post("/auth/login", response_model=LoginResponse)
-def auth_login(payload: LoginRequest):
+async def auth_login(payload: LoginRequest):
     email = payload.email.strip().lower()
     role = payload.role.strip().lower()
-    if role not in ("patient", "doctor"):
+    if role not in _VALID_ROLES:
         raise HTTPException(status_code=400, detail="role must be 'patient' or 'doctor'")
 
     doctor_name = None
     if role == "doctor":
-        if email not in DOCTOR_EMAIL_MAP:
+        doctor_name = _DOCTOR_EMAIL_MAP_NORM.get(email)
+        if doctor_name is None:
             raise HTTPException(status_code=403, detail="Unknown doctor email")
-        doctor_name = DOCTOR_EMAIL_MAP[email]
 
-    token = str(uuid.uuid4())
-    TOKENS[token] = {"email": email, "role": role, "doctor_name": doctor_name}
+    token = secrets.token_urlsafe(16)
+    await token_store.put(token, {"email": email, "role": role, "doctor_name": doctor_name})
     return {"token": token, "role": role, "doctor_name": doctor_name}
 
-def get_token_info(x_auth: Optional[str] = Header(None), x_role: Optional[str] = Header(None)):
-    if not x_auth:
-        raise HTTPException(status_code=401, detail="X-AUTH header required")
-    info = TOKENS.get(x_auth)
-    if not info:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    if x_role and info.get("role") != x_role:
-        raise HTTPException(status_code=403, detail="Role mismatch")
-    return info
-
 # AI API endpoints
 class AIRequest(BaseModel):
+    # Blank messages are rejected during validation, after surrounding whitespace is stripped
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     session_id: Optional[str] = None
-    message: str
+    message: str = Field(min_length=1, max_length=4096)
+
+def _sse_response(payload: AIRequest, token_info: dict) -> StreamingResponse:
+    async def event_stream():
+        async for event in ai.process_user_message_stream(payload.session_id, payload.message, token_info=token_info):
+            if orjson is not None:
+                yield b"data: " + orjson.dumps(event) + b"\n\n"
+            else:
+                yield f"data: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 @app.post("/api/ai")
-def api_ai(payload: AIRequest, token_info: dict = Depends(get_token_info)):
-    if not payload.message or payload.message.strip() == "":
-        raise HTTPException(status_code=400, detail="message required")
-    result = ai.process_user_message(payload.session_id, payload.message, token_info=token_info)
+async def api_ai(payload: AIRequest, request: Request, accept: Optional[str] = Header(None)):
+    token_info = request.state.token_info
+    # Clients that ask for an event stream get the reply token by token
+    if accept and "text/event-stream" in accept:
+        return _sse_response(payload, token_info)
+    result = await ai.process_user_message(payload.session_id, payload.message, token_info=token_info)
     return result
 
+@app.post("/api/ai/stream")
+async def api_ai_stream(payload: AIRequest, request: Request):
+    return _sse_response(payload, request.state.token_info)
+
+class AIBatchRequest(BaseModel):
+    requests: List[AIRequest] = Field(min_length=1)
+    urgency: Literal["low-latency", "batch"] = "low-latency"
+
+@app.post("/api/ai/batch")
+async def api_ai_batch(payload: AIBatchRequest, request: Request):
+    items = [(r.session_id, r.message) for r in payload.requests]
+    return await ai.process_user_messages_batch(items, payload.urgency, token_info=request.state.token_info)
+
+@app.get("/api/ai/batch/{batch_id}")
+async def api_ai_batch_result(batch_id: str, request: Request):
+    out = await ai.fetch_openai_batch(batch_id, token_info=request.state.token_info)
+    if out is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    return out
+
+# Seconds a WebSocket client has to send its auth frame after connecting
+WS_AUTH_TIMEOUT = 10
+
+async def _ws_authenticate(ws: WebSocket) -> Optional[dict]:
+    # Browsers can't set headers on a WebSocket handshake, and query strings end up in access
+    # logs, so the token arrives in the first frame: {"type": "auth", "token": "..."}
+    try:
+        frame = await asyncio.wait_for(ws.receive_json(), timeout=WS_AUTH_TIMEOUT)
+    except (asyncio.TimeoutError, ValueError):
+        return None
+    if not isinstance(frame, dict) or frame.get("type") != "auth" or not isinstance(frame.get("token"), str):
+        return None
+    return await token_store.get(frame["token"])
+
+@app.websocket("/ws/ai")
+async def ws_ai(ws: WebSocket):
+    await ws.accept()
+    try:
+        token_info = await _ws_authenticate(ws)
+    except WebSocketDisconnect:
+        return
+    if not token_info:
+        await ws.close(code=1008, reason="Invalid token")
+        return
+    await ws.send_json({"type": "auth", "ok": True})
+
+    session_id = None
+    try:
+        while True:
+            try:
+                payload = AIRequest.model_validate(await ws.receive_json())
+            except (ValidationError, ValueError) as e:
+                await ws.send_json({"type": "error", "detail": str(e)})
+                continue
+            # One connection is one conversation unless the client names a session
+            session_id = payload.session_id or session_id
+            async for event in ai.process_user_message_stream(session_id, payload.message, token_info=token_info):
+                if event["type"] == "session":
+                    session_id = event["session_id"]
+                await ws.send_text(orjson.dumps(event).decode() if orjson is not None else json.dumps(event))
+    except WebSocketDisconnect:
+        pass
+
 @app.get("/api/session/{session_id}")
-def get_session(session_id: str):
-    return ai.dump_session(session_id)
+async def get_session(session_id: str):
+    return await ai.dump_session(session_id)
+
+# Response cache lifetimes in seconds: the doctor list rarely changes, reports change with bookings
+DOCTORS_CACHE_TTL = 60
+REPORT_CACHE_TTL = 10
 
 class ReportRequest(BaseModel):
     doctor_name: Optional[str] = None
@@ -93,7 +206,8 @@ class ReportRequest(BaseModel):
     send_notification: Optional[bool] = True
 
 @app.post("/doctor/report")
-def doctor_report(payload: ReportRequest, token_info: dict = Depends(get_token_info), x_role: Optional[str] = Header(None)):
+async def doctor_report(payload: ReportRequest, request: Request, db: Session = Depends(get_db)):
+    token_info = request.state.token_info
     if token_info.get("role") != "doctor":
         raise HTTPException(status_code=403, detail="Forbidden: requires doctor role")
     if payload.doctor_name:
@@ -102,16 +216,33 @@ def doctor_report(payload: ReportRequest, token_info: dict = Depends(get_token_i
     doctor_name_to_use = payload.doctor_name or token_info.get("doctor_name")
     if not doctor_name_to_use:
         raise HTTPException(status_code=400, detail="doctor_name required for report")
-    res = tools.get_doctor_summary_report(doctor_name_to_use, payload.ref_date, payload.send_notification)
+    # The report hits the DB and Slack; keep that off the event loop
+    compute = lambda: asyncio.to_thread(tools.get_doctor_summary_report, doctor_name_to_use, payload.ref_date, payload.send_notification, db)
+    if payload.send_notification:
+        # Notifying Slack is a side effect, so those requests always run
+        res = await compute()
+    else:
+        res = await cached_response(f"report:{doctor_name_to_use}:{payload.ref_date or ''}", REPORT_CACHE_TTL, compute)
     if not res.get("ok"):
         raise HTTPException(status_code=400, detail=res.get("error"))
     return res
 
+def _load_doctors(db: Session):
+    rows = db.query(Doctor.id, Doctor.name).all()
+    return [{"id": d.id, "name": d.name} for d in rows]
+
 @app.get("/doctors")
-def list_doctors():
-    db = SessionLocal()
-    try:
-        rows = db.query(Doctor).all()
-        return [{"id": d.id, "name": d.name} for d in rows]
-    finally:
-        db.close()
\ No newline at end of file
+async def list_doctors(db: Session = Depends(get_db)):
+    return await cached_response("doctors", DOCTORS_CACHE_TTL, lambda: asyncio.to_thread(_load_doctors, db))
+
+if __name__ == "__main__":
+    import uvicorn
+    # "auto" picks uvloop and httptools when installed (not available on Windows)
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="auto",
+        http="auto",
+    )
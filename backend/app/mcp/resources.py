@@ -1,6 +1,7 @@
-from datetime import datetime, timedelta, time
+from datetime import timedelta
 from typing import Dict
-from email.mime.text import MIMEText
+from functools import lru_cache
+from email.header import Header
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -8,6 +9,7 @@ from googleapiclient.discovery import build
 import os
 import json
 import base64
+import threading
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))  
 GOOGLE_DIR = os.path.join(BASE_DIR, "google")
@@ -21,39 +23,82 @@ SCOPES = [
 ]
 
 
+def _token_mtime():
+    try:
+        return os.stat(TOKEN_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Last loaded credentials as (scopes, token mtime, creds); reloaded when token.json changes
+_creds_cache = None
+_creds_lock = threading.Lock()
+
+
 def get_google_credentials(scopes=SCOPES) -> Credentials or None:
+    global _creds_cache
     if not os.path.exists(CREDENTIALS_PATH):
         return None
 
-    creds = None
-    # Load existing token if present
-    if os.path.exists(TOKEN_PATH):
-        creds = Credentials.from_authorized_user_file(TOKEN_PATH, scopes)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except Exception as e:
-                creds = None
-        if not creds:
-            try:
-                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, scopes)
-                creds = flow.run_local_server(port=0)
-                # Save token for next runs
-                with open(TOKEN_PATH, "w") as token_file:
-                    token_file.write(creds.to_json())
-            except Exception as e:
-                return None
-    return creds
+    with _creds_lock:
+        mtime = _token_mtime()
+        if _creds_cache is not None:
+            cached_scopes, cached_mtime, cached = _creds_cache
+            if cached_scopes == tuple(scopes) and cached_mtime == mtime and cached.valid:
+                return cached
+
+        creds = None
+        # Load existing token if present
+        if mtime is not None:
+            creds = Credentials.from_authorized_user_file(TOKEN_PATH, scopes)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                try:
+                    creds.refresh(Request())
+                except Exception as e:
+                    creds = None
+            if not creds:
+                try:
+                    flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, scopes)
+                    creds = flow.run_local_server(port=0)
+                    # Save token for next runs
+                    with open(TOKEN_PATH, "w") as token_file:
+                        token_file.write(creds.to_json())
+                except Exception as e:
+                    return None
+        _creds_cache = (tuple(scopes), _token_mtime(), creds)
+        return creds
+
+# Built Google API clients, reused until token.json changes. httplib2 connections are not
+# thread-safe and tools run in worker threads, so each thread keeps its own clients.
+_service_cache = threading.local()
+
+
+def _get_service(name: str, version: str):
+    services = getattr(_service_cache, "services", None)
+    if services is None:
+        services = _service_cache.services = {}
+
+    mtime = _token_mtime()
+    cached = services.get((name, version))
+    if cached is not None and mtime is not None and cached[0] == mtime:
+        return cached[1]
 
-def send_calendar_event_google(doctor_name: str, patient_name: str, start_iso: str, end_iso: str) -> Dict:
     creds = get_google_credentials()
     if not creds:
+        return None
+    service = build(name, version, credentials=creds, cache_discovery=False)
+    # Re-read the mtime: loading the credentials may have just written token.json
+    services[(name, version)] = (_token_mtime(), service)
+    return service
+
+def send_calendar_event_google(doctor_name: str, patient_name: str, start_iso: str, end_iso: str) -> Dict:
+    service = _get_service("calendar", "v3")
+    if not service:
         # Fallback simulated result
         return {"ok": True, "source": "simulated_calendar", "note": "missing_credentials_or_token"}
 
     try:
-        service = build("calendar", "v3", credentials=creds, cache_discovery=False)
         event = {
             "summary": f"Appointment: {patient_name} with {doctor_name}",
             "description": f"Appointment booked via MCP system. Patient: {patient_name}",
@@ -65,20 +110,42 @@ def send_calendar_event_google(doctor_name: str, patient_name: str, start_iso: s
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
+def _header_value(value: str) -> str:
+    # No header injection through embedded newlines; non-ASCII goes out RFC 2047 encoded
+    value = " ".join(str(value).splitlines())
+    return value if value.isascii() else Header(value, "utf-8").encode()
+
+
+def _build_raw_email(to_email: str, subject: str, body_text: str, from_name: str = None) -> str:
+    """
+    Assemble a plain-text RFC 5322 message directly and return it base64url-encoded,
+    as the Gmail API expects, without going through email.generator.
+    """
+    headers = []
+    if from_name:
+        headers.append(f"From: {_header_value(from_name)}")
+    headers.append(f"To: {_header_value(to_email)}")
+    headers.append(f"Subject: {_header_value(subject)}")
+    headers.append("MIME-Version: 1.0")
+    headers.append('Content-Type: text/plain; charset="utf-8"')
+    if body_text.isascii():
+        headers.append("Content-Transfer-Encoding: 7bit")
+        body = body_text.encode()
+    else:
+        headers.append("Content-Transfer-Encoding: base64")
+        body = base64.encodebytes(body_text.encode())
+    message = "\r\n".join(headers).encode() + b"\r\n\r\n" + body
+    return base64.urlsafe_b64encode(message).decode()
+
+
 def send_email_gmail_api(to_email: str, subject: str, body_text: str, from_name: str = None) -> Dict:
 
-    creds = get_google_credentials()
-    if not creds:
+    service = _get_service("gmail", "v1")
+    if not service:
         return {"ok": True, "source": "simulated_email", "note": "missing_credentials_or_token"}
 
     try:
-        service = build("gmail", "v1", credentials=creds, cache_discovery=False)
-        message = MIMEText(body_text, "plain")
-        if from_name:
-            message["From"] = from_name
-        message["To"] = to_email
-        message["Subject"] = subject
-        raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        raw = _build_raw_email(to_email, subject, body_text, from_name)
         send_result = service.users().messages().send(userId="me", body={"raw": raw}).execute()
         return {"ok": True, "source": "gmail_api", "message_id": send_result.get("id")}
     except Exception as e:
@@ -97,14 +164,11 @@ def send_email_stub(to_email: str, subject: str, body: str):
     return res   
 
 def daterange(start_date, end_date):
-    current = start_date
-    while current <= end_date:
-        yield current
-        current += timedelta(days=1)
-
-def time_to_iso(dt_date, dt_time):
-    return datetime.combine(dt_date, dt_time).isoformat()
+    # Inclusive list of dates; empty when end_date is before start_date
+    days = (end_date - start_date).days + 1
+    return [start_date + timedelta(days=i) for i in range(days)]
 
+@lru_cache(maxsize=8)
 def parse_time_of_day_filter(time_of_day: str):
     """
     Accept 'morning', 'afternoon', 'evening', or None.
@@ -1,19 +1,42 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import monotonic
 from datetime import datetime, date, time, timedelta
-from typing import List, Dict
-from app.db import SessionLocal
+from typing import Dict, List, NamedTuple, Optional
+from app.db import scoped_session
 from app.models import Doctor, Appointment
-from sqlalchemy import func
+from sqlalchemy import bindparam, exists, func, select, text
+from sqlalchemy.orm import Session
+from requests.adapters import HTTPAdapter
 from .resources import (
     daterange,
     parse_time_of_day_filter,
     send_calendar_event_stub,
     send_email_stub,
-    time_to_iso,
 )
-import os, requests
+import os, re, requests, threading
 
 SLOT_MINUTES = 60  # use 60-minute appointment slots for simplicity
 
+# Outbound notifications (Google Calendar, Gmail, Slack) run here so requests don't wait on them
+_background = ThreadPoolExecutor(max_workers=int(os.getenv("NOTIFY_WORKERS", "4")), thread_name_prefix="notify")
+_QUEUED = {"ok": True, "status": "queued"}
+
+def _run_background(label: str, fn, *args):
+    try:
+        res = fn(*args)
+        if not res.get("ok"):
+            print(f"{label} failed:", res.get("error") or res)
+    except Exception as e:
+        print(f"{label} failed:", e)
+
+def shutdown_background():
+    # Let queued notifications finish before the process exits
+    _background.shutdown(wait=True)
+
+# Names and reasons repeat constantly, so both normalizers are memoized
+@lru_cache(maxsize=1024)
 def _normalize_doc_name(name: str) -> str:
     if not name:
         return ""
@@ -23,81 +46,222 @@ def _normalize_doc_name(name: str) -> str:
     return name.replace("  ", " ").replace("dr ", "dr. ").strip()
 
 
-def _get_doctor_by_name(db, doctor_name: str):
+# Hot-path statements, built once at import. Values are bound per call, so SQLAlchemy
+# compiles each statement a single time and reuses it from its compiled cache.
+_DOCTORS_STMT = select(Doctor.id, Doctor.name).order_by(Doctor.id)
+_DOCTOR_BY_NAME_STMT = select(Doctor.id, Doctor.name).where(func.lower(Doctor.name) == bindparam("name")).limit(1)
+_BOOKED_STMT = select(Appointment.date, Appointment.start_time).where(
+    Appointment.doctor_id == bindparam("doctor_id"),
+    Appointment.date.between(bindparam("start_date"), bindparam("end_date"))
+)
+_BOOKED_MANY_STMT = select(Appointment.doctor_id, Appointment.date, Appointment.start_time).where(
+    Appointment.doctor_id.in_(bindparam("doctor_ids", expanding=True)),
+    Appointment.date.between(bindparam("start_date"), bindparam("end_date"))
+)
+_CONFLICT_STMT = select(exists().where(
+    Appointment.doctor_id == bindparam("doctor_id"),
+    Appointment.date == bindparam("day"),
+    Appointment.start_time == bindparam("start_time")
+))
+_DAY_COUNTS_STMT = select(Appointment.date, func.count(Appointment.id)).where(
+    Appointment.doctor_id == bindparam("doctor_id"),
+    Appointment.date.in_(bindparam("days", expanding=True))
+).group_by(Appointment.date)
+_REASON_COUNTS_STMT = select(Appointment.reason, func.count(Appointment.id)).where(
+    Appointment.doctor_id == bindparam("doctor_id"),
+    Appointment.date == bindparam("day")
+).group_by(Appointment.reason)
+# Postgres only, opt-in via AVAILABILITY_IN_SQL=1: every (day, hour) slot in the window that
+# has no appointment starting at that time, generated and filtered in the database so booked
+# slots never leave it.
+AVAILABILITY_IN_SQL = os.getenv("AVAILABILITY_IN_SQL", "0") == "1"
+_FREE_SLOTS_PG_STMT = text("""
+    SELECT d::date AS day, h AS hour
+    FROM generate_series(CAST(:start_date AS date), CAST(:end_date AS date), interval '1 day') AS d
+    CROSS JOIN generate_series(CAST(:start_hour AS integer), CAST(:end_hour AS integer) - 1, CAST(:step AS integer)) AS h
+    WHERE NOT EXISTS (
+        SELECT 1 FROM appointments a
+        WHERE a.doctor_id = :doctor_id AND a.date = d::date AND a.start_time = make_time(h, 0, 0)
+    )
+    ORDER BY d, h
+""")
+
+class DoctorRef(NamedTuple):
+    id: int
+    name: str
+
+# Doctors are few and rarely change, so the whole lowercased name -> DoctorRef map is loaded
+# in one query and reused for DOCTOR_SNAPSHOT_TTL seconds. Plain tuples rather than ORM
+# objects: they outlive the session that loaded them.
+DOCTOR_SNAPSHOT_TTL = int(os.getenv("DOCTOR_SNAPSHOT_TTL", "60"))
+_doctor_snapshot = None  # (loaded_at, {name_lower: DoctorRef})
+_doctor_snapshot_lock = threading.Lock()
+
+def invalidate_doctor_cache():
+    global _doctor_snapshot
+    with _doctor_snapshot_lock:
+        _doctor_snapshot = None
+
+def _doctor_map(db) -> Dict[str, DoctorRef]:
+    global _doctor_snapshot
+    with _doctor_snapshot_lock:
+        if _doctor_snapshot is not None and monotonic() - _doctor_snapshot[0] < DOCTOR_SNAPSHOT_TTL:
+            return _doctor_snapshot[1]
+        doctors = {}
+        for row in db.execute(_DOCTORS_STMT):
+            doctors.setdefault(row.name.lower(), DoctorRef(row.id, row.name))
+        _doctor_snapshot = (monotonic(), doctors)
+        return doctors
+
+def _get_doctor_by_name(db, doctor_name: str) -> Optional[DoctorRef]:
     if not doctor_name:
         return None
 
-    target = _normalize_doc_name(doctor_name)
-
     # exact match only
-    doc = db.query(Doctor).filter(func.lower(Doctor.name) == target).first()
-
-    return doc
-
-def _existing_slots_for_date(db, doctor_id: int, target_date: date) -> List[time]:
-    rows = db.query(Appointment).filter(
-        Appointment.doctor_id == doctor_id,
-        Appointment.date == target_date
-    ).all()
-    return [r.start_time for r in rows]
+    target = _normalize_doc_name(doctor_name)
+    doc = _doctor_map(db).get(target)
+    if doc is not None:
+        return doc
+
+    # Not in the snapshot: the doctor may have been added since it was loaded (e.g. by
+    # seed in another process). This is a point lookup on ix_doc_name_lower.
+    row = db.execute(_DOCTOR_BY_NAME_STMT, {"name": target}).first()
+    if row is None:
+        return None
+    invalidate_doctor_cache()
+    return DoctorRef(row.id, row.name)
 
-def get_doctor_availability(doctor_name: str, start_date_str: str, end_date_str: str = None, time_of_day: str = None) -> Dict:
+@lru_cache(maxsize=16)
+def _slot_template(start_hour: int, end_hour: int) -> tuple:
+    """
+    (slot_start, start_str, end_str) for each slot in the hour window. Identical for every
+    day, so it is built once per window instead of once per day.
+    """
+    step = SLOT_MINUTES // 60
+    return tuple(
+        (time(hour, 0), time(hour, 0).isoformat(), time(hour + step, 0).isoformat())
+        for hour in range(start_hour, end_hour, step)
+    )
+
+def _parse_date_range(start_date_str: str, end_date_str: str = None):
+    start_date = datetime.fromisoformat(start_date_str).date()
+    end_date = start_date if not end_date_str else datetime.fromisoformat(end_date_str).date()
+    return start_date, end_date
+
+def _free_slots(booked, start_date, end_date, slots) -> list:
+    """
+    Slot dicts for every day in the range, minus the start times in booked[day].
+    """
+    available = []
+    for single_date in daterange(start_date, end_date):
+        existing = booked.get(single_date)
+        # most days have no bookings in the window; only filter the template when needed
+        free = slots if not existing else [slot for slot in slots if slot[0] not in existing]
+        day_iso = single_date.isoformat()
+        # slots are on the hour, so the ISO datetime is plain concatenation
+        available.extend({
+            "date": day_iso,
+            "start_time": start_str,
+            "end_time": end_str,
+            "start_iso": f"{day_iso}T{start_str}",
+            "end_iso": f"{day_iso}T{end_str}"
+        } for _, start_str, end_str in free)
+    return available
+
+def _free_slots_pg(db, doctor_id: int, start_date, end_date, time_of_day: str = None) -> list:
+    """
+    Same result as _free_slots, computed by _FREE_SLOTS_PG_STMT in a single round trip.
+    """
+    start_hour, end_hour = parse_time_of_day_filter(time_of_day)
+    slots_by_hour = {slot[0].hour: slot for slot in _slot_template(start_hour, end_hour)}
+    rows = db.execute(_FREE_SLOTS_PG_STMT, {
+        "start_date": start_date,
+        "end_date": end_date,
+        "start_hour": start_hour,
+        "end_hour": end_hour,
+        "step": SLOT_MINUTES // 60,
+        "doctor_id": doctor_id,
+    })
+    available = []
+    for day, hour in rows:
+        day_iso = day.isoformat()
+        _, start_str, end_str = slots_by_hour[hour]
+        available.append({
+            "date": day_iso,
+            "start_time": start_str,
+            "end_time": end_str,
+            "start_iso": f"{day_iso}T{start_str}",
+            "end_iso": f"{day_iso}T{end_str}"
+        })
+    return available
+
+def get_doctor_availability(doctor_name: str, start_date_str: str, end_date_str: str = None, time_of_day: str = None, db: Optional[Session] = None) -> Dict:
     """
     Returns available slots between start_date and end_date (inclusive).
     start_date_str, end_date_str expected in YYYY-MM-DD format.
+    Uses the caller's session when db is given, otherwise opens its own.
     """
-    db = SessionLocal()
-    try:
+    with scoped_session(db) as db:
         doc = _get_doctor_by_name(db, doctor_name)
         if not doc:
             return {"ok": False, "error": f"Doctor '{doctor_name}' not found"}
 
-        start_date = datetime.fromisoformat(start_date_str).date()
-        end_date = start_date if not end_date_str else datetime.fromisoformat(end_date_str).date()
-        start_hour, end_hour = parse_time_of_day_filter(time_of_day)
-        available = []
-
-        for single_date in daterange(start_date, end_date):
-            existing = _existing_slots_for_date(db, doc.id, single_date)
-            # generate hourly slots
-            hour = start_hour
-            while hour < end_hour:
-                slot_start = time(hour, 0)
-                slot_end_hour = hour + (SLOT_MINUTES // 60)
-                slot_end = time(slot_end_hour, 0)
-                if slot_start not in existing:
-                    # append ISO strings
-                    available.append({
-                        "date": single_date.isoformat(),
-                        "start_time": slot_start.isoformat(),
-                        "end_time": slot_end.isoformat(),
-                        "start_iso": time_to_iso(single_date, slot_start),
-                        "end_iso": time_to_iso(single_date, slot_end)
-                    })
-                hour += (SLOT_MINUTES // 60)
-        return {"ok": True, "doctor": doc.name, "available_slots": available}
-    finally:
-        db.close()
-
-def create_appointment(doctor_name: str, patient_name: str, patient_email: str, start_iso: str, end_iso: str, reason: str = None) -> Dict:
+        start_date, end_date = _parse_date_range(start_date_str, end_date_str)
+        if AVAILABILITY_IN_SQL and db.get_bind().dialect.name == "postgresql":
+            return {"ok": True, "doctor": doc.name, "available_slots": _free_slots_pg(db, doc.id, start_date, end_date, time_of_day)}
+        slots = _slot_template(*parse_time_of_day_filter(time_of_day))
+
+        # booked start times for the whole range in one query, bucketed by day
+        booked = defaultdict(set)
+        rows = db.execute(_BOOKED_STMT, {"doctor_id": doc.id, "start_date": start_date, "end_date": end_date})
+        for day, start_time in rows:
+            booked[day].add(start_time)
+
+        return {"ok": True, "doctor": doc.name, "available_slots": _free_slots(booked, start_date, end_date, slots)}
+
+def get_doctor_availability_many(doctor_names: List[str], start_date_str: str, end_date_str: str = None, time_of_day: str = None, db: Optional[Session] = None) -> Dict:
+    """
+    get_doctor_availability for several doctors at once, with one appointments query for
+    all of them. "results" holds one entry per requested name, in order, shaped like the
+    single-doctor result.
+    """
+    with scoped_session(db) as db:
+        docs = [_get_doctor_by_name(db, name) for name in doctor_names]
+        start_date, end_date = _parse_date_range(start_date_str, end_date_str)
+        slots = _slot_template(*parse_time_of_day_filter(time_of_day))
+
+        # doctor_id -> day -> booked start times
+        booked = defaultdict(lambda: defaultdict(set))
+        doc_ids = {doc.id for doc in docs if doc}
+        if doc_ids:
+            rows = db.execute(_BOOKED_MANY_STMT, {"doctor_ids": list(doc_ids), "start_date": start_date, "end_date": end_date})
+            for doctor_id, day, start_time in rows:
+                booked[doctor_id][day].add(start_time)
+
+        results = []
+        for name, doc in zip(doctor_names, docs):
+            if not doc:
+                results.append({"ok": False, "error": f"Doctor '{name}' not found"})
+            else:
+                results.append({"ok": True, "doctor": doc.name, "available_slots": _free_slots(booked[doc.id], start_date, end_date, slots)})
+        return {"ok": True, "results": results}
+
+def create_appointment(doctor_name: str, patient_name: str, patient_email: str, start_iso: str, end_iso: str, reason: str = None, db: Optional[Session] = None) -> Dict:
     """
-    Create appointment in DB. Attempt to create calendar event and send email.
+    Create appointment in DB. The calendar event and confirmation email are sent in the
+    background, so their results are reported as "queued".
     start_iso/end_iso are ISO 8601 datetime strings.
+    Uses the caller's session when db is given, otherwise opens its own.
     """
-    db = SessionLocal()
-    try:
+    with scoped_session(db) as db:
         doc = _get_doctor_by_name(db, doctor_name)
         if not doc:
             return {"ok": False, "error": f"Doctor '{doctor_name}' not found"}
 
         start_dt = datetime.fromisoformat(start_iso)
         end_dt = datetime.fromisoformat(end_iso)
-        # Check conflict
-        conflict = db.query(Appointment).filter(
-            Appointment.doctor_id == doc.id,
-            Appointment.date == start_dt.date(),
-            Appointment.start_time == start_dt.time()
-        ).first()
+        # Check conflict: EXISTS lets the (doctor_id, date) index answer without fetching a row
+        conflict = db.execute(_CONFLICT_STMT, {"doctor_id": doc.id, "day": start_dt.date(), "start_time": start_dt.time()}).scalar()
         if conflict:
             return {"ok": False, "error": "Slot already booked"}
 
@@ -110,24 +274,23 @@ def create_appointment(doctor_name: str, patient_name: str, patient_email: str,
             reason=reason or ""
         )
         db.add(appt)
+        # flush assigns the id; reading it before commit avoids a refresh SELECT afterwards
+        db.flush()
+        appointment_id = appt.id
         db.commit()
-        db.refresh(appt)
 
-        cal_result = send_calendar_event_stub(doc.name, patient_name, start_dt.isoformat(), end_dt.isoformat())
-        email_result = send_email_stub(patient_email, f"Appointment with {doc.name}", f"Your appointment on {start_dt.isoformat()}")
+        _background.submit(_run_background, "Calendar event", send_calendar_event_stub, doc.name, patient_name, start_dt.isoformat(), end_dt.isoformat())
+        _background.submit(_run_background, "Confirmation email", send_email_stub, patient_email, f"Appointment with {doc.name}", f"Your appointment on {start_dt.isoformat()}")
 
         return {
             "ok": True,
-            "appointment_id": appt.id,
-            "calendar": cal_result,
-            "email": email_result
+            "appointment_id": appointment_id,
+            "calendar": dict(_QUEUED),
+            "email": dict(_QUEUED)
         }
-    finally:
-        db.close()
 
-def get_doctor_stats(doctor_name: str, ref_date_str: str = None) -> dict:
-    db = SessionLocal()
-    try:
+def get_doctor_stats(doctor_name: str, ref_date_str: str = None, db: Optional[Session] = None) -> dict:
+    with scoped_session(db) as db:
         doc = _get_doctor_by_name(db, doctor_name)
         if not doc:
             return {"ok": False, "error": f"Doctor '{doctor_name}' not found"}
@@ -140,29 +303,23 @@ def get_doctor_stats(doctor_name: str, ref_date_str: str = None) -> dict:
         yesterday = ref_date - timedelta(days=1)
         tomorrow = ref_date + timedelta(days=1)
 
-        def count_on(target_date):
-            return db.query(func.count(Appointment.id)).filter(
-                Appointment.doctor_id == doc.id,
-                Appointment.date == target_date
-            ).scalar() or 0
+        # one grouped query for all three days; days without appointments are absent
+        counts = dict(db.execute(_DAY_COUNTS_STMT, {"doctor_id": doc.id, "days": [yesterday, ref_date, tomorrow]}).all())
 
-        count_yesterday = count_on(yesterday)
-        count_today = count_on(ref_date)
-        count_tomorrow = count_on(tomorrow)
+        count_yesterday = counts.get(yesterday, 0)
+        count_today = counts.get(ref_date, 0)
+        count_tomorrow = counts.get(tomorrow, 0)
 
-        rows = db.query(Appointment.reason).filter(
-            Appointment.doctor_id == doc.id,
-            Appointment.date == ref_date
-        ).all()
+        # count each distinct reason in SQL, then fold them into normalized categories
+        rows = db.execute(_REASON_COUNTS_STMT, {"doctor_id": doc.id, "day": ref_date})
 
-        # aggregate reasons with normalization
         breakdown = {}
-        for (reason,) in rows:  
+        for reason, count in rows:
             key = _normalize_reason(reason)
-            breakdown[key] = breakdown.get(key, 0) + 1
+            breakdown[key] = breakdown.get(key, 0) + count
 
-        # sort top reasons
-        top_reasons = sorted(breakdown.items(), key=lambda x: x[1], reverse=True)
+        # sort top reasons; ties by name, since grouped rows come back in no particular order
+        top_reasons = sorted(breakdown.items(), key=lambda x: (-x[1], x[0]))
 
         return {
             "ok": True,
@@ -174,25 +331,40 @@ def get_doctor_stats(doctor_name: str, ref_date_str: str = None) -> dict:
             "reasons_breakdown": breakdown,
             "top_reasons": [{"reason": r, "count": c} for r, c in top_reasons]
         }
-    finally:
-        db.close()
 
+# Reason keywords by category, matched as substrings of the lowercased reason. Categories
+# are tried in this order, so e.g. "back pain and fever" counts as fever.
+_REASON_CATEGORIES = (
+    ("fever", ("fever", "temperature", "hot")),
+    ("checkup", ("check", "checkup", "routine", "follow-up", "follow up", "consult")),
+    ("respiratory", ("cough", "cold", "flu", "sore", "throat")),
+    ("pain", ("pain", "ache", "injury", "back", "headache", "head ache")),
+    ("prescription", ("prescription", "med", "refill")),
+)
+# One pattern anchored at the start: each branch is a lookahead over the whole string, so the
+# first category with a keyword anywhere wins and names the match via lastgroup.
+_REASON_RE = re.compile(
+    "|".join(
+        rf"(?=.*?(?:{'|'.join(map(re.escape, keywords))}))(?P<{category}>)"
+        for category, keywords in _REASON_CATEGORIES
+    ),
+    re.S,
+)
+
+@lru_cache(maxsize=1024)
 def _normalize_reason(reason: str) -> str:
     if not reason:
         return "other"
     r = reason.lower().strip()
-    if any(k in r for k in ("fever", "temperature", "hot")):
-        return "fever"
-    if any(k in r for k in ("check", "checkup", "routine", "follow-up", "follow up", "consult")):
-        return "checkup"
-    if any(k in r for k in ("cough", "cold", "flu", "sore", "throat")):
-        return "respiratory"
-    if any(k in r for k in ("pain", "ache", "injury", "back", "headache", "head ache")):
-        return "pain"
-    if any(k in r for k in ("prescription", "med", "refill")):
-        return "prescription"
-    token = r.split()[0][:20]
-    return token or "other"
+    m = _REASON_RE.match(r)
+    if m:
+        return m.lastgroup
+    words = r.split()
+    return words[0][:20] if words else "other"
+
+# Keep-alive connections to the Slack webhook host, shared by the notification threads
+_slack_session = requests.Session()
+_slack_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
 
 # Slack helper (simple webhook)
 def _send_slack_message(text: str) -> dict:
@@ -201,16 +373,24 @@ def _send_slack_message(text: str) -> dict:
         return {"ok": False, "error": "no_slack_webhook"}
     payload = {"text": text}
     try:
-        resp = requests.post(webhook, json=payload, timeout=5)
+        resp = _slack_session.post(webhook, json=payload, timeout=5)
         return {"ok": resp.status_code in (200, 201, 204), "status_code": resp.status_code, "text": resp.text}
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
-def get_doctor_summary_report(doctor_name: str, ref_date_str: str = None, send_notification: bool = True) -> dict:
+def _queue_slack_message(text: str) -> dict:
+    # A missing webhook is reported straight away; the POST itself happens in the background
+    if not os.getenv("SLACK_WEBHOOK_URL"):
+        return {"ok": False, "error": "no_slack_webhook"}
+    _background.submit(_run_background, "Slack notification", _send_slack_message, text)
+    return dict(_QUEUED)
+
+def get_doctor_summary_report(doctor_name: str, ref_date_str: str = None, send_notification: bool = True, db: Optional[Session] = None) -> dict:
     """
-    Returns a human-friendly summary and optionally sends Slack notification.
+    Returns a human-friendly summary and optionally queues a Slack notification; the
+    report doesn't wait for Slack, so notification_result is {"status": "queued"}.
     """
-    stats = get_doctor_stats(doctor_name, ref_date_str)
+    stats = get_doctor_stats(doctor_name, ref_date_str, db=db)
     if not stats.get("ok"):
         return {"ok": False, "error": stats.get("error")}
 
@@ -230,7 +410,7 @@ def get_doctor_summary_report(doctor_name: str, ref_date_str: str = None, send_n
 
     notification_result = None
     if send_notification:
-        notification_result = _send_slack_message(summary_text)
+        notification_result = _queue_slack_message(summary_text)
 
     return {
         "ok": True,
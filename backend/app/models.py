@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, Time, ForeignKey
+from sqlalchemy import Column, Integer, String, Date, Time, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from .db import Base
 
@@ -9,7 +9,12 @@ class Doctor(Base):
     name = Column(String, nullable=False)
     specialization = Column(String, nullable=True)
 
-    appointments = relationship("Appointment", back_populates="doctor")
+    # Nothing walks these relationships today; lazy="raise" turns an accidental per-row
+    # lazy load (N+1) into an error. Load them explicitly with selectinload() when needed.
+    appointments = relationship("Appointment", back_populates="doctor", lazy="raise")
+
+    # Doctor lookups match on the lowercased name
+    __table_args__ = (Index("ix_doc_name_lower", func.lower(name)),)
 
 
 class Appointment(Base):
@@ -23,4 +28,7 @@ class Appointment(Base):
     end_time = Column(Time, nullable=False)
     reason = Column(String, nullable=True)
 
-    doctor = relationship("Doctor", back_populates="appointments")
+    doctor = relationship("Doctor", back_populates="appointments", lazy="raise")
+
+    # Availability, conflict checks and stats all filter by doctor and date
+    __table_args__ = (Index("ix_appt_doc_date", "doctor_id", "date"),)
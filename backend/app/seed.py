@@ -1,4 +1,4 @@
-from app.db import SessionLocal
+from app.db import scoped_session
 from app.models import Doctor
 
 DOCTORS_TO_ADD = [
@@ -11,19 +11,19 @@ DOCTORS_TO_ADD = [
 ]
 
 def seed():
-    db = SessionLocal()
-    try:
+    with scoped_session() as db:
+        # one query for the doctors already present, one commit for the rest
+        existing = {name for (name,) in db.query(Doctor.name).filter(Doctor.name.in_(DOCTORS_TO_ADD))}
+        to_add = []
         for name in DOCTORS_TO_ADD:
-            exists = db.query(Doctor).filter(Doctor.name == name).first()
-            if exists:
+            if name in existing:
                 print(f"Doctor already exists: {name}")
                 continue
-            dr = Doctor(name=name, specialization="General Physician")
-            db.add(dr)
-            db.commit()
+            to_add.append(name)
+        db.add_all([Doctor(name=name, specialization="General Physician") for name in to_add])
+        db.commit()
+        for name in to_add:
             print(f"Seeded {name}")
-    finally:
-        db.close()
 
 if __name__ == "__main__":
     seed()